@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+##\brief Per-cycle cost of the CPU usage path over the number of cores
+##
+## Runs ProcStatSampler and get_core_usage_values of cpu_monitor.py on
+## synthetic /proc/stat files, with and without NumPy. Needs a sourced
+## ROS environment for the diagnostic_msgs import of cpu_monitor.py.
+
+from __future__ import print_function
+
+import sys, os
+import random
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import cpu_monitor
+
+core_counts = [ 8, 32, 64, 128, 256, 512 ]
+repeat = 200
+
+## Adds random increments to the jiffy counters of every core
+def advance_counters(counters):
+    for jiffies in counters:
+        for i in range(8):
+            jiffies[i] += random.randint(0, 100)
+
+## Writes /proc/stat like file with the jiffy counters of every core
+def write_proc_stat(path, counters, cycle):
+    lines = [ 'cpu  ' + ' '.join([ '0' ] * 10) ]
+    for core, jiffies in enumerate(counters):
+        lines.append('cpu%d %s' % (core, ' '.join([ str(x) for x in jiffies + [ 0, 0 ] ])))
+    lines.extend([ 'intr 0', 'ctxt %d' % (cycle*1000), 'btime 1600000000',
+                   'processes %d' % (cycle*10), 'procs_running 1', 'procs_blocked 0' ])
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def run_cycle(sampler):
+    names, usage = sampler.sample()
+    cpu_monitor.get_core_usage_values(names, usage, 0.9, 1.0)
+
+if __name__ == '__main__':
+    modes = [ ('python', False) ]
+    if cpu_monitor.numpy is not None:
+        modes.append(('numpy', True))
+
+    print('%8s %s' % ('cores', ' '.join([ '%12s' % ('%s [us]' % x[0]) for x in modes ])))
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for num_cores in core_counts:
+            costs = []
+            for mode, use_numpy in modes:
+                sampler = cpu_monitor.ProcStatSampler(path, use_numpy = use_numpy)
+                counters = [ [ 1000000 ]*8 for _ in range(num_cores) ]
+                write_proc_stat(path, counters, 0)
+                sampler.sample()
+
+                # Every timed cycle has to see new counters, otherwise all
+                # deltas are zero and the usage math is skipped
+                cost = 0.0
+                for cycle in range(1, repeat + 1):
+                    advance_counters(counters)
+                    write_proc_stat(path, counters, cycle)
+                    start = timeit.default_timer()
+                    run_cycle(sampler)
+                    cost += timeit.default_timer() - start
+                costs.append(cost/repeat*1e6)
+            print('%8d %s' % (num_cores, ' '.join([ '%12.1f' % x for x in costs ])))
+    finally:
+        os.remove(path)
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+############################################################################
+#    Copyright (C) 2009, Willow Garage, Inc.                               #
+#    Copyright (C) 2013 by Ralf Kaestner                                   #
+#    ralf.kaestner@gmail.com                                               #
+#    Copyright (C) 2013 by Jerome Maye                                     #
+#    jerome.maye@mavt.ethz.ch                                              #
+#                                                                          #
+#    All rights reserved.                                                  #
+#                                                                          #
+#    Redistribution and use in source and binary forms, with or without    #
+#    modification, are permitted provided that the following conditions    #
+#    are met:                                                              #
+#                                                                          #
+#    1. Redistributions of source code must retain the above copyright     #
+#       notice, this list of conditions and the following disclaimer.      #
+#                                                                          #
+#    2. Redistributions in binary form must reproduce the above copyright  #
+#       notice, this list of conditions and the following disclaimer in    #
+#       the documentation and/or other materials provided with the         #
+#       distribution.                                                      #
+#                                                                          #
+#    3. The name of the copyright holders may be used to endorse or        #
+#       promote products derived from this software without specific       #
+#       prior written permission.                                          #
+#                                                                          #
+#    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS   #
+#    "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT     #
+#    LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS     #
+#    FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE        #
+#    COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,  #
+#    INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,  #
+#    BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;      #
+#    LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER      #
+#    CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT    #
+#    LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN     #
+#    ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE       #
+#    POSSIBILITY OF SUCH DAMAGE.                                           #
+############################################################################
+
+
+from __future__ import with_statement
+
+import rospy
+
+import traceback
+import threading
+from threading import Timer
+import sys, os
+import fnmatch
+import select
+
+import socket
+
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import monotonic_time
+
+cgroup_patterns = [ 'docker/*', 'system.slice/docker-*.scope', 'kubepods*' ]
+cgroup_max_depth = 3
+cgroup_mem_level_warn = 0.9
+cgroup_mem_level_error = 0.98
+cgroup_throttle_warn = 0.25
+
+stat_dict = { 0: 'OK', 1: 'Warning', 2: 'Error' }
+
+# Files can be opened relative to cached directory descriptors
+has_dir_fd = hasattr(os, 'supports_dir_fd') and os.open in os.supports_dir_fd
+
+def update_status_stale(stat, last_update_time):
+    time_since_update = rospy.get_time() - last_update_time
+
+    stale_status = 'OK'
+    if time_since_update > 20 and time_since_update <= 35:
+        stale_status = 'Lagging'
+        if stat.level == DiagnosticStatus.OK:
+            stat.message = stale_status
+        elif stat.message.find(stale_status) < 0:
+            stat.message = ', '.join([stat.message, stale_status])
+        stat.level = max(stat.level, DiagnosticStatus.WARN)
+    if time_since_update > 35:
+        stale_status = 'Stale'
+        if stat.level == DiagnosticStatus.OK:
+            stat.message = stale_status
+        elif stat.message.find(stale_status) < 0:
+            stat.message = ', '.join([stat.message, stale_status])
+        stat.level = max(stat.level, DiagnosticStatus.ERROR)
+
+
+    stat.values.pop(0)
+    stat.values.pop(0)
+    stat.values.insert(0, KeyValue(key = 'Update Status', value = stale_status))
+    stat.values.insert(1, KeyValue(key = 'Time Since Update', value = str(time_since_update)))
+
+## Returns contents of file name in directory path, opened relative to the
+## directory descriptor dir_fd if supported. Returns None if there is no file.
+def read_cgroup_file(path, name, dir_fd = None):
+    try:
+        if has_dir_fd and dir_fd is not None:
+            fd = os.open(name, os.O_RDONLY, dir_fd = dir_fd)
+        else:
+            fd = os.open(os.path.join(path, name), os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        data = b''
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+        return data.decode('UTF-8', 'replace')
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+## Returns { key: int } of a flat keyed file like cpu.stat or memory.events
+def parse_keyed(data):
+    values = {}
+    for ln in (data or '').split('\n'):
+        words = ln.split()
+        if len(words) == 2 and words[1].isdigit():
+            values[words[0]] = int(words[1])
+    return values
+
+##\brief Tree of cgroup directories, of which some are selected by glob
+## patterns on their path relative to the root
+##
+## Directory descriptors are kept open for cgroups matching the patterns.
+## The selection is rebuilt only if a directory listing changed or, for
+## cgroup v2, cgroup.events of a matching cgroup signals a change of its
+## populated state.
+class CgroupTree():
+    def __init__(self, root, patterns, max_depth, unified):
+        self.root = root
+        self._patterns = patterns
+        self._max_depth = max_depth
+        self._unified = unified
+        self._dir_fds = {}
+        self._listings = {}
+        self._poller = select.poll()
+        self._event_fds = {}
+        self.cgroups = []
+
+    def close(self):
+        for fd in list(self._dir_fds.values()) + list(self._event_fds.keys()):
+            os.close(fd)
+        self._dir_fds = {}
+        self._event_fds = {}
+        self._listings = {}
+
+    def path(self, cgroup):
+        return os.path.join(self.root, cgroup)
+
+    def dir_fd(self, cgroup):
+        return self._dir_fds.get(cgroup)
+
+    def _list_subdirs(self, cgroup):
+        fd = self._dir_fds.get(cgroup)
+        if fd is None and has_dir_fd and self._selected(cgroup):
+            fd = os.open(self.path(cgroup), os.O_RDONLY)
+            self._dir_fds[cgroup] = fd
+
+        if hasattr(os, 'scandir'):
+            if fd is None or os.scandir not in getattr(os, 'supports_fd', set()):
+                fd = self.path(cgroup)
+            return sorted([ x.name for x in os.scandir(fd) if x.is_dir(follow_symlinks = False) ])
+        path = self.path(cgroup)
+        return sorted([ x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x)) ])
+
+    def _selected(self, cgroup):
+        if not cgroup:
+            return False
+        for pattern in self._patterns:
+            if fnmatch.fnmatch(cgroup, pattern):
+                return True
+        return False
+
+    ## Watches cgroup.events of all matching cgroups, populated or not, so
+    ## cgroups which start or stop running processes are noticed
+    def _watch_events(self, cgroups):
+        for fd in self._event_fds:
+            self._poller.unregister(fd)
+            os.close(fd)
+        self._event_fds = {}
+        if not self._unified:
+            return
+        for cgroup in cgroups:
+            try:
+                fd = os.open(os.path.join(self.path(cgroup), 'cgroup.events'), os.O_RDONLY)
+            except OSError:
+                continue
+            os.read(fd, 256)
+            self._poller.register(fd, select.POLLPRI)
+            self._event_fds[fd] = cgroup
+
+    ## Walks the directory listings and rebuilds the selection if needed,
+    ## returns True if it was rebuilt
+    def refresh(self):
+        changed = bool(self._event_fds and self._poller.poll(0))
+
+        seen = set()
+        queue = [ ('', 0) ]
+        while queue:
+            cgroup, depth = queue.pop()
+            try:
+                subdirs = self._list_subdirs(cgroup)
+            except OSError:
+                continue # Removed while walking
+            seen.add(cgroup)
+            if subdirs != self._listings.get(cgroup):
+                self._listings[cgroup] = subdirs
+                changed = True
+            if depth < self._max_depth:
+                queue.extend([ (os.path.join(cgroup, x), depth + 1) for x in subdirs ])
+
+        for cgroup in list(self._listings.keys()):
+            if cgroup not in seen:
+                del self._listings[cgroup]
+                fd = self._dir_fds.pop(cgroup, None)
+                if fd is not None:
+                    os.close(fd)
+                changed = True
+
+        if changed:
+            cgroups = [ x for x in sorted(seen) if self._selected(x) ]
+            self._watch_events(cgroups)
+            if self._unified:
+                # Skip cgroups without processes in their subtree
+                cgroups = [ x for x in cgroups if parse_keyed(read_cgroup_file(
+                    self.path(x), 'cgroup.events', self.dir_fd(x))).get('populated', 1) ]
+            self.cgroups = cgroups
+        return changed
+
+##\brief Reads usage counters of cgroups from v2 or v1 interface files
+class CgroupReader():
+    def __init__(self, root = '/sys/fs/cgroup'):
+        self._root = root
+        self.unified = os.path.exists(os.path.join(root, 'cgroup.controllers'))
+        if self.unified:
+            self.tree_root = root
+        else:
+            self.tree_root = os.path.join(root, 'cpu,cpuacct')
+            if not os.path.isdir(self.tree_root):
+                self.tree_root = os.path.join(root, 'cpu')
+
+    def _v1_path(self, controller, cgroup):
+        for name in [ controller, 'cpu,cpuacct' ]:
+            path = os.path.join(self._root, name, cgroup)
+            if os.path.isdir(path):
+                return path
+        return os.path.join(self._root, controller, cgroup)
+
+    ## Returns { name: int } with usage_usec, nr_periods, nr_throttled,
+    ## throttled_usec, memory, memory_max (None if unlimited), oom_kill,
+    ## rbytes, wbytes, rios and wios
+    def read(self, tree, cgroup):
+        if self.unified:
+            return self._read_v2(tree.path(cgroup), tree.dir_fd(cgroup))
+        return self._read_v1(tree.path(cgroup), tree.dir_fd(cgroup), cgroup)
+
+    def _read_v2(self, path, dir_fd):
+        counters = {}
+        cpu_stat = parse_keyed(read_cgroup_file(path, 'cpu.stat', dir_fd))
+        for key in [ 'usage_usec', 'nr_periods', 'nr_throttled', 'throttled_usec' ]:
+            counters[key] = cpu_stat.get(key, 0)
+
+        current = read_cgroup_file(path, 'memory.current', dir_fd)
+        counters['memory'] = int(current) if current else 0
+        limit = (read_cgroup_file(path, 'memory.max', dir_fd) or 'max').strip()
+        counters['memory_max'] = int(limit) if limit.isdigit() else None
+        counters['oom_kill'] = parse_keyed(read_cgroup_file(path, 'memory.events', dir_fd)).get('oom_kill', 0)
+
+        for key in [ 'rbytes', 'wbytes', 'rios', 'wios' ]:
+            counters[key] = 0
+        for ln in (read_cgroup_file(path, 'io.stat', dir_fd) or '').split('\n'):
+            for word in ln.split()[1:]:
+                key, value = word.split('=')
+                if key in counters:
+                    counters[key] += int(value)
+        return counters
+
+    def _read_v1(self, path, dir_fd, cgroup):
+        counters = {}
+        usage = read_cgroup_file(path, 'cpuacct.usage', dir_fd)
+        counters['usage_usec'] = int(usage)//1000 if usage else 0
+        cpu_stat = parse_keyed(read_cgroup_file(path, 'cpu.stat', dir_fd))
+        counters['nr_periods'] = cpu_stat.get('nr_periods', 0)
+        counters['nr_throttled'] = cpu_stat.get('nr_throttled', 0)
+        counters['throttled_usec'] = cpu_stat.get('throttled_time', 0)//1000
+
+        memory_path = self._v1_path('memory', cgroup)
+        current = read_cgroup_file(memory_path, 'memory.usage_in_bytes')
+        counters['memory'] = int(current) if current else 0
+        limit = int(read_cgroup_file(memory_path, 'memory.limit_in_bytes') or 0)
+        # Unlimited is reported as a huge page aligned number
+        counters['memory_max'] = limit if 0 < limit < 2**62 else None
+        counters['oom_kill'] = parse_keyed(read_cgroup_file(memory_path, 'memory.oom_control')).get('oom_kill', 0)
+
+        blkio_path = self._v1_path('blkio', cgroup)
+        for name, read_key, write_key in [ ('blkio.throttle.io_service_bytes', 'rbytes', 'wbytes'),
+                                           ('blkio.throttle.io_serviced', 'rios', 'wios') ]:
+            counters[read_key] = 0
+            counters[write_key] = 0
+            for ln in (read_cgroup_file(blkio_path, name) or '').split('\n'):
+                words = ln.split()
+                if len(words) == 3 and words[1] == 'Read':
+                    counters[read_key] += int(words[2])
+                elif len(words) == 3 and words[1] == 'Write':
+                    counters[write_key] += int(words[2])
+        return counters
+
+class CgroupMonitor():
+    def __init__(self, hostname, diag_hostname):
+        self._diag_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size = 100)
+
+        self._mutex = threading.Lock()
+
+        self._cgroup_root = rospy.get_param('~cgroup_root', '/sys/fs/cgroup')
+        self._cgroup_patterns = rospy.get_param('~cgroup_patterns', cgroup_patterns)
+        self._cgroup_max_depth = rospy.get_param('~cgroup_max_depth', cgroup_max_depth)
+        self._cgroup_mem_level_warn = rospy.get_param('~cgroup_mem_level_warn', cgroup_mem_level_warn)
+        self._cgroup_mem_level_error = rospy.get_param('~cgroup_mem_level_error', cgroup_mem_level_error)
+        self._cgroup_throttle_warn = rospy.get_param('~cgroup_throttle_warn', cgroup_throttle_warn)
+
+        self._reader = CgroupReader(self._cgroup_root)
+        self._tree = CgroupTree(self._reader.tree_root, self._cgroup_patterns,
+                                self._cgroup_max_depth, self._reader.unified)
+        self._last_counters = {}
+
+        self._usage_timer = None
+
+        self._usage_stat = DiagnosticStatus()
+        self._usage_stat.name = 'Cgroup Usage'
+        self._usage_stat.level = 1
+        self._usage_stat.hardware_id = hostname
+        self._usage_stat.message = 'No Data'
+        self._usage_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
+                                    KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
+
+        self._last_usage_time = 0
+        self._last_publish_time = 0
+
+        # Start checking everything
+        self.check_usage()
+
+    ## Must have the lock to cancel everything
+    def cancel_timers(self):
+        if self._usage_timer:
+            self._usage_timer.cancel()
+
+    ##\brief Checks CPU, memory and IO usage of the selected cgroups
+    def check_cgroups(self):
+        values = []
+        level = DiagnosticStatus.OK
+        msgs = []
+
+        try:
+            self._tree.refresh()
+            values.append(KeyValue(key = 'Cgroup Version', value = '2' if self._reader.unified else '1'))
+
+            now = monotonic_time()
+            last_counters = self._last_counters
+            self._last_counters = {}
+            for index, cgroup in enumerate(self._tree.cgroups):
+                counters = self._reader.read(self._tree, cgroup)
+                self._last_counters[cgroup] = (now, counters)
+                last_time, last = last_counters.get(cgroup, (None, None))
+
+                cgroup_level = DiagnosticStatus.OK
+                values.append(KeyValue(key = 'Cgroup %d Name' % index, value = cgroup))
+
+                if last is not None and now > last_time:
+                    elapsed = now - last_time
+                    delta = dict([ (x, max(counters[x] - last[x], 0)) for x in counters
+                                   if x != 'memory_max' ])
+                    throttled = 0.0
+                    if delta['nr_periods'] > 0:
+                        throttled = float(delta['nr_throttled'])/delta['nr_periods']
+                    if throttled > self._cgroup_throttle_warn:
+                        cgroup_level = DiagnosticStatus.WARN
+                        msgs.append('CPU Throttled')
+                    if delta['oom_kill'] > 0:
+                        cgroup_level = DiagnosticStatus.ERROR
+                        msgs.append('OOM Kill')
+
+                    values.append(KeyValue(key = 'Cgroup %d CPU Usage' % index,
+                                           value = '%.2f%%' % (delta['usage_usec']*1e-4/elapsed)))
+                    values.append(KeyValue(key = 'Cgroup %d CPU Throttled' % index,
+                                           value = '%.2f%%' % (throttled*1e2)))
+                    values.append(KeyValue(key = 'Cgroup %d CPU Throttled Time' % index,
+                                           value = '%.2fms/s' % (delta['throttled_usec']*1e-3/elapsed)))
+                    values.append(KeyValue(key = 'Cgroup %d IO Read' % index,
+                                           value = '%.3fMB/s' % (delta['rbytes']/1e6/elapsed)))
+                    values.append(KeyValue(key = 'Cgroup %d IO Write' % index,
+                                           value = '%.3fMB/s' % (delta['wbytes']/1e6/elapsed)))
+                    values.append(KeyValue(key = 'Cgroup %d IO Read Ops' % index,
+                                           value = '%.1f/s' % (delta['rios']/elapsed)))
+                    values.append(KeyValue(key = 'Cgroup %d IO Write Ops' % index,
+                                           value = '%.1f/s' % (delta['wios']/elapsed)))
+
+                values.append(KeyValue(key = 'Cgroup %d Memory' % index,
+                                       value = '%dM' % (counters['memory']/2**20)))
+                if counters['memory_max'] is None:
+                    values.append(KeyValue(key = 'Cgroup %d Memory Limit' % index, value = 'max'))
+                else:
+                    mem_usage = float(counters['memory'])/counters['memory_max']
+                    if mem_usage >= self._cgroup_mem_level_error:
+                        cgroup_level = DiagnosticStatus.ERROR
+                        msgs.append('Low Cgroup Memory')
+                    elif mem_usage >= self._cgroup_mem_level_warn:
+                        cgroup_level = max(cgroup_level, DiagnosticStatus.WARN)
+                        msgs.append('Low Cgroup Memory')
+                    values.append(KeyValue(key = 'Cgroup %d Memory Limit' % index,
+                                           value = '%dM' % (counters['memory_max']/2**20)))
+                values.append(KeyValue(key = 'Cgroup %d OOM Kills' % index, value = str(counters['oom_kill'])))
+                values.append(KeyValue(key = 'Cgroup %d Status' % index, value = stat_dict[cgroup_level]))
+
+                level = max(level, cgroup_level)
+
+        except Exception as e:
+            rospy.logerr(traceback.format_exc())
+            msgs = [ 'Cgroup Check Error' ]
+            values.append(KeyValue(key = 'Cgroup Check Error', value = str(e)))
+            level = DiagnosticStatus.ERROR
+
+        if msgs:
+            return level, ', '.join(sorted(set(msgs))), values
+        return level, stat_dict[level], values
+
+    def check_usage(self):
+        if rospy.is_shutdown():
+            with self._mutex:
+                self.cancel_timers()
+            return
+
+        diag_vals = [ KeyValue(key = 'Update Status', value = 'OK' ),
+                      KeyValue(key = 'Time Since Last Update', value = 0 )]
+
+        diag_level, usage_msg, cgroup_vals = self.check_cgroups()
+        diag_vals.extend(cgroup_vals)
+
+        # Update status
+        with self._mutex:
+            self._last_usage_time = rospy.get_time()
+            self._usage_stat.level = diag_level
+            self._usage_stat.values = diag_vals
+            self._usage_stat.message = usage_msg
+
+            if not rospy.is_shutdown():
+                self._usage_timer = threading.Timer(5.0, self.check_usage)
+                self._usage_timer.start()
+            else:
+                self.cancel_timers()
+
+    def publish_stats(self):
+        with self._mutex:
+            # Update everything with last update times
+            update_status_stale(self._usage_stat, self._last_usage_time)
+
+            msg = DiagnosticArray()
+            msg.header.stamp = rospy.get_rostime()
+            msg.status.append(self._usage_stat)
+
+            if rospy.get_time() - self._last_publish_time > 0.5:
+                self._diag_pub.publish(msg)
+                self._last_publish_time = rospy.get_time()
+
+
+if __name__ == '__main__':
+    hostname = socket.gethostname()
+    hostname = hostname.replace('-', '_')
+
+    import optparse
+    parser = optparse.OptionParser(usage="usage: cgroup_monitor.py [--diag-hostname=cX]")
+    parser.add_option("--diag-hostname", dest="diag_hostname",
+                      help="Computer name in diagnostics output (ex: 'c1')",
+                      metavar="DIAG_HOSTNAME",
+                      action="store", default = hostname)
+    options, args = parser.parse_args(rospy.myargv())
+
+    try:
+        rospy.init_node('cgroup_monitor_%s' % hostname)
+    except rospy.exceptions.ROSInitException:
+        print('Cgroup monitor is unable to initialize node. Master may not be running.')
+        sys.exit(0)
+
+    cgroup_node = CgroupMonitor(hostname, options.diag_hostname)
+
+    rate = rospy.Rate(1.0)
+    try:
+        while not rospy.is_shutdown():
+            rate.sleep()
+            cgroup_node.publish_stats()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        traceback.print_exc()
+        rospy.logerr(traceback.format_exc())
+
+    cgroup_node.cancel_timers()
+    sys.exit(0)
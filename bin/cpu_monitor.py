@@ -47,12 +47,19 @@ import threading
 from threading import Timer
 import sys, os, time
 from time import sleep
-import subprocess
-import string
+import heapq
+import array
+import math
 
 import socket
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import CachedFile, SensorIndex, TempSensorReader, monotonic_time
 
 cpu_load_warn = 0.9
 cpu_load_error = 1.1
@@ -61,18 +68,64 @@ cpu_load5_warn = 0.8
 cpu_temp_warn = 85.0
 cpu_temp_error = 90.0
 
-num_cores = subprocess.Popen('lscpu | grep "^CPU(s):"',
-                                stdout= subprocess.PIPE,
-                                stderr= subprocess.PIPE, shell=True )
-try:
-    num_cores = num_cores.communicate()[0].decode()
-    num_cores = num_cores[-3]+num_cores[-2]
-    num_cores = int(num_cores)
-except:
-    num_cores = int(num_cores.communicate()[0][-2])
-
 stat_dict = { 0: 'OK', 1: 'Warning', 2: 'Error' }
 
+## Returns CPU limit of the cgroup of this process as number of CPUs,
+## None if there is no quota. Handles cgroup v2 cpu.max and v1 CFS quota.
+def get_cgroup_cpu_limit(cgroup_root = '/sys/fs/cgroup'):
+    limits = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            cgroups = [ ln.strip().split(':', 2) for ln in f if ln.count(':') >= 2 ]
+    except (OSError, IOError):
+        return None
+
+    for hierarchy, controllers, path in cgroups:
+        if hierarchy == '0' and not controllers:
+            base = cgroup_root
+            quota_files = [ 'cpu.max' ]
+        elif 'cpu' in controllers.split(','):
+            base = os.path.join(cgroup_root, controllers)
+            if not os.path.isdir(base):
+                base = os.path.join(cgroup_root, 'cpu')
+            quota_files = [ 'cpu.cfs_quota_us', 'cpu.cfs_period_us' ]
+        else:
+            continue
+
+        # Limits of all ancestors apply, a namespaced cgroup is mounted at
+        # the root so the path may not exist
+        path = path.strip('/')
+        while True:
+            try:
+                values = []
+                for name in quota_files:
+                    with open(os.path.join(base, path, name)) as f:
+                        values.extend(f.read().split())
+                if values[0] not in ('max', '-1') and int(values[1]) > 0:
+                    limits.append(float(values[0])/float(values[1]))
+            except (OSError, IOError, IndexError, ValueError):
+                pass
+            if not path:
+                break
+            path = os.path.dirname(path)
+
+    if limits:
+        return min(limits)
+    return None
+
+## Returns effective number of CPUs this process can use, taking CPU
+## affinity and the cgroup quota into account
+def get_cpu_capacity():
+    if hasattr(os, 'sched_getaffinity'):
+        capacity = float(len(os.sched_getaffinity(0)))
+    else:
+        capacity = float(os.sysconf('SC_NPROCESSORS_ONLN'))
+
+    cgroup_limit = get_cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        capacity = min(capacity, cgroup_limit)
+    return capacity
+
 def update_status_stale(stat, last_update_time):
     time_since_update = rospy.get_time() - last_update_time
 
@@ -98,6 +151,476 @@ def update_status_stale(stat, last_update_time):
     stat.values.insert(0, KeyValue(key = 'Update Status', value = stale_status))
     stat.values.insert(1, KeyValue(key = 'Time Since Update', value = str(time_since_update)))
 
+## Returns core names, per-core cpu lines and the remaining lines of
+## /proc/stat contents
+def split_proc_stat(data):
+    lines = data.split('\n')
+
+    # Per-core lines follow the summary line
+    num_cores = 0
+    while num_cores + 1 < len(lines) and lines[num_cores + 1].startswith('cpu'):
+        num_cores += 1
+    cpu_lines = lines[1:num_cores + 1]
+    names = [ ln[3:ln.find(' ')] for ln in cpu_lines ]
+    return names, cpu_lines, lines[num_cores + 1:]
+
+## Returns the user, nice, system, idle, iowait, irq, softirq and steal
+## jiffies of cpu lines as NumPy array with a row per core
+##
+## Only the numbers are handed to NumPy's text parser, which is about
+## twice as fast as converting the split words.
+def parse_cpu_jiffies(cpu_lines):
+    jiffies = numpy.fromstring(' '.join([ ln[ln.find(' '):] for ln in cpu_lines ]),
+                               dtype = numpy.int64, sep = ' ').reshape(len(cpu_lines), -1)
+    if jiffies.shape[1] < 8:
+        # Old kernels have no steal and irq columns
+        jiffies = numpy.hstack([ jiffies, numpy.zeros((len(cpu_lines), 8 - jiffies.shape[1]),
+                                                      dtype = numpy.int64) ])
+    return jiffies[:, :8]
+
+##\brief Per-core CPU usage from /proc/stat jiffy counter deltas
+##
+## Keeps the counters of the previous sample, so every call returns the
+## usage since the last one. The first call returns usage since boot.
+## Process counts and context switch and fork rates of the same read are
+## kept in the stats dictionary. The per-core math is done on arrays if
+## NumPy is available.
+class ProcStatSampler():
+    stat_counters = [ 'ctxt', 'btime', 'processes', 'procs_running', 'procs_blocked' ]
+    idle_usage = (0.0, 0.0, 0.0, 100.0, 0.0, 0.0, 0.0)
+
+    def __init__(self, path = '/proc/stat', use_numpy = True):
+        self._file = CachedFile(path, 65536)
+        self._use_numpy = use_numpy and numpy is not None
+        self._last_names = None
+        self._last_jiffies = None
+        self._last_usage = None
+        self._last_counters = None
+        self._last_time = None
+        self.stats = {}
+
+    ## Updates stats from the non-cpu lines of /proc/stat
+    def _update_stats(self, counters):
+        now = monotonic_time()
+        if self._last_counters is None:
+            # Rates since boot for the first sample
+            last_counters = { 'ctxt': 0, 'processes': 0 }
+            elapsed = time.time() - counters.get('btime', 0)
+        else:
+            last_counters = self._last_counters
+            elapsed = now - self._last_time
+
+        self.stats = { 'procs_running': counters.get('procs_running', 0),
+                       'procs_blocked': counters.get('procs_blocked', 0) }
+        for key, rate_key in [ ('ctxt', 'ctxt_rate'), ('processes', 'fork_rate') ]:
+            delta = counters.get(key, 0) - last_counters.get(key, 0)
+            self.stats[rate_key] = delta/elapsed if elapsed > 0 and delta >= 0 else 0.0
+
+        self._last_counters = counters
+        self._last_time = now
+
+    ## Returns usage rows for the cpu lines, in percent
+    def _usage_numpy(self, names, cpu_lines):
+        # Guest time is already accounted in user and nice
+        jiffies = parse_cpu_jiffies(cpu_lines)
+
+        if names != self._last_names:
+            # Cores went on- or offline, start over with usage since boot
+            self._last_jiffies = numpy.zeros(jiffies.shape, dtype = numpy.int64)
+            self._last_usage = numpy.tile(self.idle_usage, (len(names), 1))
+
+        delta = jiffies - self._last_jiffies
+        total = delta.sum(axis = 1)
+        # No tick elapsed or counters were reset, keep previous usage
+        valid = (total > 0) & (delta.min(axis = 1) >= 0)
+
+        percent = delta*1e2/numpy.maximum(total, 1)[:, None]
+        usage = percent[:, [ 0, 1, 2, 3, 4, 5, 7 ]]
+        usage[:, 5] += percent[:, 6]
+        usage = numpy.where(valid[:, None], usage, self._last_usage)
+
+        self._last_jiffies = jiffies
+        self._last_usage = usage
+        return usage
+
+    ## Returns usage rows for the cpu lines, in percent
+    def _usage_python(self, names, cpu_lines):
+        if names != self._last_names:
+            self._last_jiffies = {}
+            self._last_usage = {}
+
+        usage = []
+        for cpu_name, ln in zip(names, cpu_lines):
+            jiffies = [ int(x) for x in ln.split()[1:9] ]
+            jiffies.extend([ 0 ] * (8 - len(jiffies)))
+
+            last = self._last_jiffies.get(cpu_name, [ 0 ] * 8)
+            delta = [ cur - old for cur, old in zip(jiffies, last) ]
+            self._last_jiffies[cpu_name] = jiffies
+
+            total = float(sum(delta))
+            if total > 0 and min(delta) >= 0:
+                core_usage = (delta[0]*1e2/total, delta[1]*1e2/total,
+                              delta[2]*1e2/total, delta[3]*1e2/total,
+                              delta[4]*1e2/total, (delta[5] + delta[6])*1e2/total,
+                              delta[7]*1e2/total)
+                self._last_usage[cpu_name] = core_usage
+            else:
+                core_usage = self._last_usage.get(cpu_name, self.idle_usage)
+
+            usage.append(core_usage)
+
+        return usage
+
+    ## Returns list of cores and their usage rows of (user, nice, system,
+    ## idle, iowait, irq, steal) in percent, ordered as in /proc/stat.
+    ## The rows are a NumPy array if NumPy is used.
+    def sample(self):
+        names, cpu_lines, lines = split_proc_stat(self._file.read())
+
+        counters = {}
+        for ln in lines:
+            words = ln.split()
+            if len(words) == 2 and words[0] in self.stat_counters:
+                counters[words[0]] = int(words[1])
+
+        if self._use_numpy:
+            usage = self._usage_numpy(names, cpu_lines)
+        else:
+            usage = self._usage_python(names, cpu_lines)
+        self._last_names = names
+
+        self._update_stats(counters)
+        return names, usage
+
+## Returns KeyValues for cores and their usage rows and the number of
+## cores with load above load_warn
+##
+## Levels are computed on whole arrays with NumPy, only the values are
+## formatted per core.
+def get_core_usage_values(names, usage, load_warn, load_error):
+    load_dict = { 0: 'OK', 1: 'High Load', 2: 'Error' }
+
+    if numpy is not None and isinstance(usage, numpy.ndarray):
+        load = (usage[:, 0] + usage[:, 1])*1e-2
+        loaded = load >= load_warn
+        levels = numpy.where(loaded, DiagnosticStatus.WARN,
+                             numpy.where(load >= load_error, DiagnosticStatus.ERROR,
+                                         DiagnosticStatus.OK)).tolist()
+        cores_loaded = int(loaded.sum())
+        usage = usage.tolist()
+    else:
+        levels = []
+        cores_loaded = 0
+        for row in usage:
+            load = (row[0] + row[1])*1e-2
+            if load >= load_warn:
+                cores_loaded += 1
+                levels.append(DiagnosticStatus.WARN)
+            elif load >= load_error:
+                levels.append(DiagnosticStatus.ERROR)
+            else:
+                levels.append(DiagnosticStatus.OK)
+
+    vals = []
+    for cpu_name, level, row in zip(names, levels, usage):
+        vals.append(KeyValue(key = 'Core %s Status' % cpu_name, value = load_dict[level]))
+        vals.append(KeyValue(key = 'Core %s User' % cpu_name, value = '%.2f%%' % row[0]))
+        vals.append(KeyValue(key = 'Core %s Nice' % cpu_name, value = '%.2f%%' % row[1]))
+        vals.append(KeyValue(key = 'Core %s System' % cpu_name, value = '%.2f%%' % row[2]))
+        vals.append(KeyValue(key = 'Core %s Idle' % cpu_name, value = '%.2f%%' % row[3]))
+        vals.append(KeyValue(key = 'Core %s IOWait' % cpu_name, value = '%.2f%%' % row[4]))
+        vals.append(KeyValue(key = 'Core %s IRQ' % cpu_name, value = '%.2f%%' % row[5]))
+        vals.append(KeyValue(key = 'Core %s Steal' % cpu_name, value = '%.2f%%' % row[6]))
+
+    return vals, cores_loaded
+
+##\brief Per-core clock speeds from cpufreq through cached descriptors
+##
+## Falls back to the MHz values of /proc/cpuinfo for cores without cpufreq,
+## e.g. in virtual machines. /proc/cpuinfo is parsed only once since it is
+## expensive to generate on many-core hosts. Only scaling_cur_freq is kept
+## open, limits and governor are read when the online cores change, so a
+## many-core host does not run into the open file limit.
+class CPUFreqReader():
+    def __init__(self, root = '/sys/devices/system/cpu', cpuinfo_path = '/proc/cpuinfo'):
+        self._root = root
+        self._cpuinfo_path = cpuinfo_path
+        self._online_file = CachedFile(os.path.join(root, 'online'), 256)
+        self._online = None
+        self._cores = []
+        self._cpuinfo_speeds = None
+
+    def close(self):
+        for core in self._cores:
+            if core[1] is not None:
+                core[1].close()
+        self._cores = []
+        self._online = None
+
+    ## Returns list of cpu ids of a cpu list like '0-3,8'
+    def _parse_cpu_list(self, cpu_list):
+        cpus = []
+        for part in cpu_list.strip().split(','):
+            if '-' in part:
+                first, last = part.split('-')
+                cpus.extend(range(int(first), int(last) + 1))
+            elif part:
+                cpus.append(int(part))
+        return cpus
+
+    def _get_cpuinfo_speeds(self):
+        if self._cpuinfo_speeds is None:
+            self._cpuinfo_speeds = {}
+            cpu_name = None
+            with open(self._cpuinfo_path) as f:
+                for ln in f:
+                    words = ln.split(':')
+                    if len(words) < 2:
+                        continue
+                    if words[0].strip() == 'processor':
+                        cpu_name = words[1].strip()
+                    elif words[0].strip() == 'cpu MHz' and cpu_name is not None:
+                        self._cpuinfo_speeds[cpu_name] = float(words[1])
+        return self._cpuinfo_speeds
+
+    def _update_cores(self):
+        online = self._online_file.read()
+        if online == self._online:
+            return
+
+        self.close()
+        for cpu in self._parse_cpu_list(online):
+            freq_path = os.path.join(self._root, 'cpu%d' % cpu, 'cpufreq')
+            cur_freq = None
+            min_speed = max_speed = governor = None
+            if os.path.exists(os.path.join(freq_path, 'scaling_cur_freq')):
+                cur_freq = CachedFile(os.path.join(freq_path, 'scaling_cur_freq'), 32)
+                min_speed = self._parse_freq(self._read_attr(freq_path, 'scaling_min_freq'))
+                max_speed = self._parse_freq(self._read_attr(freq_path, 'scaling_max_freq'))
+                governor = self._read_attr(freq_path, 'scaling_governor')
+            self._cores.append(('%d' % cpu, cur_freq, min_speed, max_speed, governor))
+        self._online = online
+
+    ## Returns stripped contents of a cpufreq attribute, None if it cannot
+    ## be read
+    def _read_attr(self, freq_path, name):
+        try:
+            with open(os.path.join(freq_path, name)) as f:
+                return f.read().strip()
+        except (OSError, IOError):
+            return None
+
+    ## Returns a cpufreq value in kHz as MHz, None if the driver reports
+    ## something else like '<unknown>'
+    def _parse_freq(self, freq):
+        try:
+            return int(freq)*1e-3
+        except (ValueError, TypeError):
+            return None
+
+    ## Returns list of (core, speed, min speed, max speed, governor) with
+    ## speeds in MHz, limits and governor are None without cpufreq
+    def read(self):
+        self._update_cores()
+
+        speeds = []
+        for cpu_name, cur_freq, min_speed, max_speed, governor in self._cores:
+            speed = None
+            if cur_freq is not None:
+                speed = self._parse_freq(cur_freq.read().strip())
+            if speed is None:
+                speed = self._get_cpuinfo_speeds().get(cpu_name)
+            if speed is not None:
+                speeds.append((cpu_name, speed, min_speed, max_speed, governor))
+        return speeds
+
+##\brief Tracks the processes using most CPU time from /proc/[pid]/stat
+##
+## Keeps utime+stime and start time of every pid, so the CPU usage of a
+## process is the delta since its last read and reused pids are detected.
+## A scan stops once the time budget of a cycle is spent and continues on
+## the next cycle. Kernel threads which did not run are only re-read on
+## every kthread_rescan-th scan.
+class ProcessCPUTracker():
+    PF_KTHREAD = 0x00200000
+
+    def __init__(self, num_processes = 5, time_budget = 0.1, kthread_rescan = 10, proc_root = '/proc'):
+        self._num_processes = num_processes
+        self._time_budget = time_budget
+        self._kthread_rescan = kthread_rescan
+        self._proc_root = proc_root
+        self._clk_tck = float(os.sysconf('SC_CLK_TCK'))
+        # pid -> [start time, cpu jiffies, read time, name, kernel thread, usage]
+        self._procs = {}
+        self._pending = []
+        self._seen = set()
+        self._scans = 0
+
+    def _read_stat(self, pid):
+        fd = os.open('%s/%s/stat' % (self._proc_root, pid), os.O_RDONLY)
+        try:
+            return os.read(fd, 1024).decode('UTF-8', 'replace')
+        finally:
+            os.close(fd)
+
+    def _update_process(self, pid, now):
+        proc = self._procs.get(pid)
+        if (proc is not None and proc[4] and proc[5] == 0.0 and
+            self._scans % self._kthread_rescan != 0):
+            return
+
+        try:
+            stat = self._read_stat(pid)
+        except (OSError, IOError):
+            return # Process exited
+
+        # Name may contain spaces and parentheses
+        name_end = stat.rfind(')')
+        name = stat[stat.find('(') + 1:name_end]
+        fields = stat[name_end + 2:].split()
+        flags = int(fields[6])
+        jiffies = int(fields[11]) + int(fields[12])
+        start_time = int(fields[19])
+
+        usage = 0.0
+        if proc is not None and proc[0] == start_time and now > proc[2]:
+            usage = (jiffies - proc[1])/self._clk_tck/(now - proc[2])*1e2
+        self._procs[pid] = [ start_time, jiffies, now, name,
+                             bool(flags & self.PF_KTHREAD), usage ]
+
+    ## Continues the scan of /proc until it completes or the time budget
+    ## is spent
+    def update(self):
+        start = monotonic_time()
+        if not self._pending:
+            # Drop processes which were not found by the last complete scan
+            for pid in list(self._procs.keys()):
+                if pid not in self._seen:
+                    del self._procs[pid]
+            self._pending = [ x for x in os.listdir(self._proc_root) if x.isdigit() ]
+            self._seen = set(self._pending)
+            self._scans += 1
+
+        while self._pending:
+            now = monotonic_time()
+            if now - start > self._time_budget:
+                break
+            self._update_process(self._pending.pop(), now)
+
+    ## Returns list of (pid, name, usage) of the top processes, usage in
+    ## percent of one core
+    def top(self):
+        top_procs = heapq.nlargest(self._num_processes, self._procs.items(),
+                                   key = lambda x: x[1][5])
+        return [ (pid, proc[3], proc[5]) for pid, proc in top_procs if proc[5] > 0.0 ]
+
+
+##\brief Lean per-core busy percentage sampler for high sampling rates
+##
+## Only computes 100% minus idle and iowait from /proc/stat deltas, it
+## has its own counters so it does not disturb ProcStatSampler. The cpu
+## lines are parsed like in ProcStatSampler, on arrays if NumPy is
+## available.
+class CoreBusySampler():
+    def __init__(self, path = '/proc/stat', use_numpy = True):
+        self._file = CachedFile(path, 65536)
+        self._use_numpy = use_numpy and numpy is not None
+        self._last_names = None
+        self._last_total = None
+        self._last_idle = None
+
+    ## Returns core names and their busy percentages since the last call,
+    ## None for the first call and after cores went on- or offline, as the
+    ## counters then cover the time since boot
+    def sample(self):
+        names, cpu_lines, lines = split_proc_stat(self._file.read())
+
+        if self._use_numpy:
+            jiffies = parse_cpu_jiffies(cpu_lines)
+            total = jiffies.sum(axis = 1)
+            idle = jiffies[:, 3] + jiffies[:, 4]
+        else:
+            total = []
+            idle = []
+            for ln in cpu_lines:
+                jiffies = [ int(x) for x in ln.split()[1:9] ]
+                total.append(sum(jiffies))
+                idle.append(jiffies[3] + jiffies[4])
+
+        last_names, last_total, last_idle = self._last_names, self._last_total, self._last_idle
+        self._last_names, self._last_total, self._last_idle = names, total, idle
+        if names != last_names:
+            return None
+
+        if self._use_numpy:
+            total_delta = total - last_total
+            busy_delta = total_delta - (idle - last_idle)
+            busy = numpy.clip(busy_delta*1e2/numpy.maximum(total_delta, 1), 0.0, 1e2)
+            return names, numpy.where(total_delta > 0, busy, 0.0)
+
+        busy = []
+        for cur_total, cur_idle, old_total, old_idle in zip(total, idle, last_total, last_idle):
+            total_delta = cur_total - old_total
+            busy_delta = total_delta - (cur_idle - old_idle)
+            busy.append(min(max(busy_delta*1e2/total_delta, 0.0), 1e2) if total_delta > 0 else 0.0)
+        return names, busy
+
+##\brief Fixed-size ring buffer of busy percentages per core
+##
+## With NumPy the buffer is one array with a row per core and the
+## percentiles are selected with numpy.partition around the median instead
+## of sorting every window.
+class UsageHistory():
+    percentiles = [ 50, 95, 99 ]
+
+    def __init__(self, num_samples, use_numpy = True):
+        self._num_samples = max(1, int(num_samples))
+        self._use_numpy = use_numpy and numpy is not None
+        self._names = None
+        self._samples = None
+        self._index = 0
+        self._count = 0
+
+    def add(self, names, busy):
+        if names != self._names:
+            # Cores went on- or offline, start a new window
+            self._names = names
+            if self._use_numpy:
+                self._samples = numpy.zeros((len(names), self._num_samples))
+            else:
+                self._samples = [ array.array('d', [ 0.0 ] * self._num_samples) for x in names ]
+            self._index = 0
+            self._count = 0
+
+        if self._use_numpy:
+            self._samples[:, self._index] = busy
+        else:
+            for samples, value in zip(self._samples, busy):
+                samples[self._index] = value
+        self._index = (self._index + 1) % self._num_samples
+        self._count = min(self._count + 1, self._num_samples)
+
+    ## Returns list of (core, [ p50, p95, p99, max ]) over the window
+    def summary(self):
+        if not self._count:
+            return []
+        ranks = [ min(self._count - 1, int(math.ceil(p*1e-2*self._count)) - 1)
+                  for p in self.percentiles ] + [ self._count - 1 ]
+
+        if self._use_numpy:
+            # All reported values are at or above the median, so only the
+            # upper half of each window is put in order
+            median = ranks[0]
+            upper = numpy.partition(self._samples[:, :self._count], median, axis = 1)[:, median:]
+            upper.sort(axis = 1)
+            values = upper[:, [ x - median for x in ranks ]].tolist()
+        else:
+            values = []
+            for samples in self._samples:
+                window = sorted(samples[:self._count])
+                values.append([ window[x] for x in ranks ])
+        return list(zip(self._names, values))
 
 class CPUMonitor():
     def __init__(self, hostname, diag_hostname):
@@ -114,13 +637,27 @@ class CPUMonitor():
         self._cpu_temp_warn = rospy.get_param('~cpu_temp_warn', cpu_temp_warn)
         self._cpu_temp_error = rospy.get_param('~cpu_temp_error', cpu_temp_error)
 
-        self._num_cores = rospy.get_param('~num_cores', num_cores)
+        # Detected from /proc/stat and cgroup quota when zero
+        self._num_cores = rospy.get_param('~num_cores', 0)
+        self._cpu_capacity_param = rospy.get_param('~cpu_capacity', 0.0)
+        self._cpu_capacity = self._cpu_capacity_param
+
+        self._check_top_processes = rospy.get_param('~check_top_processes', False)
+        self._num_top_processes = rospy.get_param('~num_top_processes', 5)
+        self._top_processes_budget = rospy.get_param('~top_processes_budget', 0.1)
+
+        self._sample_rate = rospy.get_param('~sample_rate', 0.0)
+        self._sample_window = rospy.get_param('~sample_window', 2.0)
+        self._sample_cpu_budget = rospy.get_param('~sample_cpu_budget', 0.01)
 
         self._temps_timer = None
         self._usage_timer = None
+        self._sample_thread = None
+        self._sample_stop = threading.Event()
+        self._sample_mutex = threading.Lock()
 
-        # Get temp_input files
-        self._temp_vals = self.get_core_temp_names()
+        # Index temperature sensors
+        self._sensor_index = SensorIndex()
 
         # CPU stats
         self._temp_stat = DiagnosticStatus()
@@ -139,15 +676,34 @@ class CPUMonitor():
         self._usage_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
                                     KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
 
+        self._process_stat = DiagnosticStatus()
+        self._process_stat.name = 'CPU Top Processes'
+        self._process_stat.level = DiagnosticStatus.OK
+        self._process_stat.hardware_id = hostname
+        self._process_stat.message = 'No Data'
+        self._process_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
+                                      KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
+        self._process_tracker = None
+        if self._check_top_processes:
+            self._process_tracker = ProcessCPUTracker(self._num_top_processes,
+                                                      self._top_processes_budget)
+
         self._last_temp_time = 0
         self._last_usage_time = 0
         self._last_publish_time = 0
 
-        self._usage_old = 0
-        self._has_warned_mpstat = False
+        self._stat_sampler = ProcStatSampler()
+        self._temp_reader = TempSensorReader()
+        self._freq_reader = CPUFreqReader()
         self._has_error_core_count = False
 
         # Start checking everything
+        if self._sample_rate > 0:
+            self._usage_history = UsageHistory(self._sample_rate*self._sample_window)
+            self._sample_thread = threading.Thread(target = self.sample_usage)
+            self._sample_thread.daemon = True
+            self._sample_thread.start()
+
         self.check_temps()
         self.check_usage()
 
@@ -172,41 +728,85 @@ class CPUMonitor():
         if self._usage_timer:
             self._usage_timer.cancel()
 
+        self._sample_stop.set()
+
+    ##\brief Samples core usage at ~sample_rate into the usage history
+    ##
+    ## The cost of a sample grows with the number of cores. It is measured
+    ## over the first samples and the rate is lowered if sampling would
+    ## take more than ~sample_cpu_budget of one core.
+    def sample_usage(self):
+        sampler = CoreBusySampler()
+        period = 1.0/self._sample_rate
+        cpu_time = getattr(time, 'thread_time', monotonic_time)
+        num_timed = 0
+        sample_cost = 0.0
+        num_cores = 0
+        next_time = monotonic_time()
+        while not rospy.is_shutdown():
+            try:
+                start = cpu_time()
+                cores = sampler.sample()
+                if cores is not None:
+                    with self._sample_mutex:
+                        self._usage_history.add(*cores)
+                    if num_timed < 10:
+                        sample_cost += cpu_time() - start
+                        num_timed += 1
+                        num_cores = len(cores[0])
+            except Exception:
+                rospy.logerr('Exception sampling CPU usage: %s' % traceback.format_exc())
+
+            if num_timed == 10:
+                num_timed += 1
+                sample_cost /= 10
+                max_rate = self._sample_cpu_budget/max(sample_cost, 1e-9)
+                if self._sample_rate > max_rate:
+                    rospy.logwarn('Sampling %d cores takes %.0fus, lowering ~sample_rate from '
+                                  '%.1fHz to %.1fHz to stay within %.1f%% of a core' %
+                                  (num_cores, sample_cost*1e6, self._sample_rate, max_rate,
+                                   self._sample_cpu_budget*1e2))
+                    self._sample_rate = max_rate
+                    period = 1.0/self._sample_rate
+                    with self._sample_mutex:
+                        self._usage_history = UsageHistory(self._sample_rate*self._sample_window)
+
+            next_time = max(next_time + period, monotonic_time())
+            if self._sample_stop.wait(next_time - monotonic_time()):
+                break
+
+    ## Returns percentiles of core usage since sampling thread started
+    def check_usage_history(self):
+        vals = []
+        with self._sample_mutex:
+            summary = self._usage_history.summary()
+        for cpu_name, (p50, p95, p99, max_usage) in summary:
+            vals.append(KeyValue(key = 'Core %s Usage P50' % cpu_name, value = '%.2f%%' % p50))
+            vals.append(KeyValue(key = 'Core %s Usage P95' % cpu_name, value = '%.2f%%' % p95))
+            vals.append(KeyValue(key = 'Core %s Usage P99' % cpu_name, value = '%.2f%%' % p99))
+            vals.append(KeyValue(key = 'Core %s Usage Max' % cpu_name, value = '%.2f%%' % max_usage))
+        return vals
+
     ##\brief Check CPU core temps
     ##
-    ## Use 'find /sys -name temp1_input' to find cores
-    ## Read from every core, divide by 1000
-    def check_core_temps(self, sys_temp_strings):
+    ## Read from every sensor through cached descriptors, divide by 1000
+    def check_core_temps(self, sensors):
         diag_vals = []
         diag_level = 0
         diag_msgs = []
 
-        for index, temp_str in enumerate(sys_temp_strings):
-            if len(temp_str) < 5:
-                continue
-
-            cmd = 'cat %s' % temp_str
-            p = subprocess.Popen(cmd, stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE, shell = True)
-            stdout, stderr = p.communicate()
-            retcode = p.returncode
-
-            if retcode != 0:
-                diag_level = DiagnosticStatus.ERROR
-                diag_msg = [ 'Core Temperature Error' ]
-                diag_vals = [ KeyValue(key = 'Core Temperature Error', value = stderr),
-                              KeyValue(key = 'Output', value = stdout) ]
-                return diag_vals, diag_msgs, diag_level
-
-            tmp = stdout.strip()
-            if not isinstance(tmp, str):
-                tmp_u = tmp.decode("UTF-8")
-            else:
-                tmp_u = unicode(tmp)
-
-            if tmp_u.isnumeric():
+        try:
+            temps = self._temp_reader.read(sensors)
+        except (OSError, IOError) as e:
+            diag_level = DiagnosticStatus.ERROR
+            diag_msgs = [ 'Core Temperature Error' ]
+            diag_vals = [ KeyValue(key = 'Core Temperature Error', value = str(e)) ]
+            return diag_vals, diag_msgs, diag_level
+
+        for label, tmp in temps:
+            if tmp.isdigit():
                 temp = float(tmp) / 1000
-                diag_vals.append(KeyValue(key = 'Core %d Temperature' % index, value = str(temp)+"DegC"))
+                diag_vals.append(KeyValue(key = '%s Temperature' % label, value = str(temp)+"DegC"))
 
                 if temp >= self._cpu_temp_warn:
                     diag_level = max(diag_level, DiagnosticStatus.WARN)
@@ -216,41 +816,25 @@ class CPUMonitor():
                     diag_msgs.append('Hot')
             else:
                 diag_level = max(diag_level, DiagnosticStatus.ERROR) # Error if not numeric value
-                diag_vals.append(KeyValue(key = 'Core %s Temperature' % index, value = tmp))
+                diag_vals.append(KeyValue(key = '%s Temperature' % label, value = tmp))
 
         return diag_vals, diag_msgs, diag_level
 
-    ## Checks clock speed from reading from CPU info
+    ## Checks clock speed, limits and governor from cpufreq
     def check_clock_speed(self):
         vals = []
         msgs = []
         lvl = DiagnosticStatus.OK
 
         try:
-            p = subprocess.Popen('cat /proc/cpuinfo | grep MHz',
-                                stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE, shell = True)
-            stdout, stderr = p.communicate()
-            retcode = p.returncode
-
-            if retcode != 0:
-                lvl = DiagnosticStatus.ERROR
-                msgs = [ 'Clock speed error' ]
-                vals = [ KeyValue(key = 'Clock speed error', value = stderr),
-                        KeyValue(key = 'Output', value = stdout) ]
-
-                return (vals, msgs, lvl)
-
-            if sys.version_info.major == 3:
-                stdout = stdout.decode('UTF-8')
-
-            for index, ln in enumerate(stdout.split('\n')):
-                words = ln.split(':')
-                if len(words) < 2:
-                    continue
-
-                speed = words[1].strip().split('.')[0] # Conversion to float doesn't work with decimal
-                vals.append(KeyValue(key = 'Core %d Clock Speed' % index, value = speed+"MHz"))
+            for cpu_name, speed, min_speed, max_speed, governor in self._freq_reader.read():
+                vals.append(KeyValue(key = 'Core %s Clock Speed' % cpu_name, value = '%dMHz' % speed))
+                if min_speed is not None:
+                    vals.append(KeyValue(key = 'Core %s Min Clock Speed' % cpu_name, value = '%dMHz' % min_speed))
+                if max_speed is not None:
+                    vals.append(KeyValue(key = 'Core %s Max Clock Speed' % cpu_name, value = '%dMHz' % max_speed))
+                if governor is not None:
+                    vals.append(KeyValue(key = 'Core %s Governor' % cpu_name, value = governor))
 
         except Exception as e:
             rospy.logerr(traceback.format_exc())
@@ -261,31 +845,19 @@ class CPUMonitor():
         return vals, msgs, lvl
 
 
-    # Add msgs output, too
-    ##\brief Uses 'uptime' to see load average
-    def check_uptime(self):
+    ##\brief Uses os.getloadavg() to see load average
+    ##
+    ## Run queue counts and rates come from the last /proc/stat sample
+    def check_load(self):
         level = DiagnosticStatus.OK
         vals = []
 
         load_dict = { 0: 'OK', 1: 'High Load', 2: 'Very High Load' }
 
         try:
-            p = subprocess.Popen('uptime', stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE, shell = True)
-            stdout, stderr = p.communicate()
-            retcode = p.returncode
-
-            if retcode != 0:
-                vals.append(KeyValue(key = 'uptime Failed', value = stderr))
-                return DiagnosticStatus.ERROR, vals
-            
-            if sys.version_info.major == 3:
-                stdout = stdout.decode('UTF-8')
-            
-            upvals = stdout.split()
-            load1 = float(upvals[-3].rstrip(',').replace(',','.'))/self._num_cores
-            load5 = float(upvals[-2].rstrip(',').replace(',','.'))/self._num_cores
-            load15 = float(upvals[-1].replace(',','.'))/self._num_cores
+            if not self._cpu_capacity:
+                self._cpu_capacity = get_cpu_capacity()
+            load1, load5, load15 = [ x/self._cpu_capacity for x in os.getloadavg() ]
 
             # Give warning if we go over load limit
             if load1 > self._cpu_load1_warn or load5 > self._cpu_load5_warn:
@@ -295,6 +867,14 @@ class CPUMonitor():
             vals.append(KeyValue(key = 'Load Average (1min)', value = str(load1*1e2)+"%"))
             vals.append(KeyValue(key = 'Load Average (5min)', value = str(load5*1e2)+"%"))
             vals.append(KeyValue(key = 'Load Average (15min)', value = str(load15*1e2)+"%"))
+            vals.append(KeyValue(key = 'Effective CPU Capacity', value = '%.2f' % self._cpu_capacity))
+
+            stats = self._stat_sampler.stats
+            if stats:
+                vals.append(KeyValue(key = 'Processes Running', value = str(stats['procs_running'])))
+                vals.append(KeyValue(key = 'Processes Blocked', value = str(stats['procs_blocked'])))
+                vals.append(KeyValue(key = 'Context Switches', value = '%.1f/s' % stats['ctxt_rate']))
+                vals.append(KeyValue(key = 'Forks', value = '%.1f/s' % stats['fork_rate']))
 
         except Exception as e:
             rospy.logerr(traceback.format_exc())
@@ -303,81 +883,19 @@ class CPUMonitor():
 
         return level, load_dict[level], vals
 
-    ##\brief Use mpstat to find CPU usage
+    ##\brief Use /proc/stat jiffy deltas to find CPU usage
     ##
-    def check_mpstat(self):
+    def check_proc_stat(self):
         vals = []
         mp_level = DiagnosticStatus.OK
 
         load_dict = { 0: 'OK', 1: 'High Load', 2: 'Error' }
         try:
-            p = subprocess.Popen('mpstat -P ALL 1 1',
-                                stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE, shell = True)
-            stdout, stderr = p.communicate()
-            try:
-                stdout = stdout.decode()
-            except:
-                stdout = stdout
-            retcode = p.returncode
-            if retcode != 0:
-                if not self._has_warned_mpstat:
-                    rospy.logerr("mpstat failed to run for cpu_monitor. Return code %d.", retcode)
-                    self._has_warned_mpstat = True
-
-                mp_level = DiagnosticStatus.ERROR
-                vals.append(KeyValue(key = '\"mpstat\" Call Error', value = str(retcode)))
-                return mp_level, 'Unable to Check CPU Usage', vals
-
-            # Check which column '%idle' is, #4539
-            # mpstat output changed between 8.06 and 8.1
-            rows = stdout.split('\n')
-            col_names = rows[2].split()
-
-            idle_col = -1 if (len(col_names) > 2 and col_names[-1] == '%idle') else -2
-            num_cores = 0
-            cores_loaded = 0
-            for index, row in enumerate(stdout.split('\n')):
-                if index < 3:
-                    continue
-
-                # Skip row containing 'all' data
-                if row.find('all') > -1:
-                    continue
-                lst = row.split()
-                if len(lst) < 8:
-                    continue
-
-                ## Ignore 'Average: ...' data
-                if lst[0].startswith('Average') or lst[0].startswith('Media'):
-                    continue
-
-                cpu_name = '%d' % (num_cores)
-                idle = lst[idle_col]
-                user = lst[2].replace(",",".")
-                nice = lst[3].replace(",",".")
-                system = lst[4].replace(",",".")
-
-                core_level = 0
-                usage = (float(user)+float(nice))*1e-2
-                if usage > 10.0: # wrong reading, use old reading instead
-                    rospy.logwarn('Read CPU usage of %f percent. Reverting to previous reading of %f percent'%(usage, self._usage_old))
-                    usage = self._usage_old
-                self._usage_old = usage
-
-                if usage >= self._cpu_load_warn:
-                    cores_loaded += 1
-                    core_level = DiagnosticStatus.WARN
-                elif usage >= self._cpu_load_error:
-                    core_level = DiagnosticStatus.ERROR
-
-                vals.append(KeyValue(key = 'Core %s Status' % cpu_name, value = load_dict[core_level]))
-                vals.append(KeyValue(key = 'Core %s User' % cpu_name, value = user+"%"))
-                vals.append(KeyValue(key = 'Core %s Nice' % cpu_name, value = nice+"%"))
-                vals.append(KeyValue(key = 'Core %s System' % cpu_name, value = system+"%"))
-                vals.append(KeyValue(key = 'Core %s Idle' % cpu_name, value = idle+"%"))
-
-                num_cores += 1
+            names, usage = self._stat_sampler.sample()
+
+            vals, cores_loaded = get_core_usage_values(names, usage, self._cpu_load_warn,
+                                                       self._cpu_load_error)
+            num_cores = len(names)
 
             # Warn for high load only if we have <= 2 cores that aren't loaded
             if num_cores - cores_loaded <= 2 and num_cores > 2:
@@ -394,39 +912,29 @@ class CPUMonitor():
                                   self._num_cores, num_cores)
                     self._has_error_core_count = True
                 self._num_cores = num_cores
+                self._cpu_capacity = self._cpu_capacity_param
                 return DiagnosticStatus.WARN, 'Incorrect number of CPU cores', vals
 
         except Exception as e:
             mp_level = DiagnosticStatus.ERROR
-            vals.append(KeyValue(key = 'mpstat Exception', value = str(e)))
+            vals.append(KeyValue(key = 'CPU Usage Exception', value = str(e)))
 
         return mp_level, load_dict[mp_level], vals
 
-    ## Returns names for core temperature files
-    ## Returns list of names, each name can be read like file
-    def get_core_temp_names(self):
-        temp_vals = []
+    ## Returns sensors for core temperatures, CPU hwmon sensors if there
+    ## are any, otherwise CPU thermal zones or any thermal zone
+    def get_core_temp_sensors(self):
         try:
-            p = subprocess.Popen('find /sys/devices -name temp1_input',
-                                stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE, shell = True)
-            stdout, stderr = p.communicate()
-            retcode = p.returncode
-
-            if sys.version_info.major == 3:
-                stdout = stdout.decode('UTF-8')
-
-            if retcode != 0:
-                rospy.logerr('Error find core temp locations: %s' % stderr)
-                return []
+            self._sensor_index.refresh()
+        except (OSError, IOError):
+            rospy.logerr('Exception indexing temperature sensors: %s' % traceback.format_exc())
 
-            for ln in stdout.split('\n'):
-                temp_vals.append(ln.strip())
-
-            return temp_vals
-        except:
-            rospy.logerr('Exception finding temp vals: %s' % traceback.format_exc())
-            return []
+        sensors = self._sensor_index.sensors('cpu', 'hwmon')
+        if not sensors:
+            sensors = self._sensor_index.sensors('cpu', 'thermal')
+        if not sensors:
+            sensors = self._sensor_index.sensors(source = 'thermal')
+        return sensors
 
     ## Call every 10sec at minimum
     def check_temps(self):
@@ -441,7 +949,7 @@ class CPUMonitor():
         diag_level = 0
 
         if self._check_core_temps:
-            core_vals, core_msgs, core_level = self.check_core_temps(self._temp_vals)
+            core_vals, core_msgs, core_level = self.check_core_temps(self.get_core_temp_sensors())
             diag_vals.extend(core_vals)
             diag_msgs.extend(core_msgs)
             diag_level = max(diag_level, core_level)
@@ -465,6 +973,22 @@ class CPUMonitor():
             else:
                 self.cancel_timers()
 
+    ##\brief Lists processes with the highest CPU usage since last cycle
+    def check_top_processes(self):
+        vals = []
+        try:
+            self._process_tracker.update()
+            for index, (pid, name, usage) in enumerate(self._process_tracker.top()):
+                vals.append(KeyValue(key = 'Process %d Name' % index, value = name))
+                vals.append(KeyValue(key = 'Process %d PID' % index, value = pid))
+                vals.append(KeyValue(key = 'Process %d CPU' % index, value = '%.1f%%' % usage))
+        except Exception as e:
+            rospy.logerr(traceback.format_exc())
+            vals.append(KeyValue(key = 'Top Processes Exception', value = str(e)))
+            return DiagnosticStatus.ERROR, vals
+
+        return DiagnosticStatus.OK, vals
+
     def check_usage(self):
         if rospy.is_shutdown():
             with self._mutex:
@@ -482,15 +1006,19 @@ class CPUMonitor():
         diag_msgs.extend(clock_msgs)
         diag_level = max(diag_level, clock_level)
 
-        # Check mpstat
-        mp_level, mp_msg, mp_vals = self.check_mpstat()
+        # Check /proc/stat
+        mp_level, mp_msg, mp_vals = self.check_proc_stat()
         diag_vals.extend(mp_vals)
         if mp_level > 0:
             diag_msgs.append(mp_msg)
         diag_level = max(diag_level, mp_level)
 
-        # Check uptime
-        uptime_level, up_msg, up_vals = self.check_uptime()
+        # Short spikes within the cycle from the high rate samples
+        if self._sample_thread:
+            diag_vals.extend(self.check_usage_history())
+
+        # Check load average, uses the /proc/stat sample from above
+        uptime_level, up_msg, up_vals = self.check_load()
         diag_vals.extend(up_vals)
         if uptime_level > 0:
             diag_msgs.append(up_msg)
@@ -501,8 +1029,18 @@ class CPUMonitor():
         else:
             usage_msg = stat_dict[diag_level]
 
+        if self._process_tracker:
+            process_level, process_vals = self.check_top_processes()
+
         # Update status
         with self._mutex:
+            if self._process_tracker:
+                self._process_stat.level = process_level
+                self._process_stat.message = stat_dict[process_level]
+                self._process_stat.values = [ KeyValue(key = 'Update Status', value = 'OK' ),
+                                              KeyValue(key = 'Time Since Last Update', value = 0 ) ]
+                self._process_stat.values.extend(process_vals)
+
             self._last_usage_time = rospy.get_time()
             self._usage_stat.level = diag_level
             self._usage_stat.values = diag_vals
@@ -525,6 +1063,10 @@ class CPUMonitor():
             msg.status.append(self._temp_stat)
             msg.status.append(self._usage_stat)
 
+            if self._process_tracker:
+                update_status_stale(self._process_stat, self._last_usage_time)
+                msg.status.append(self._process_stat)
+
             if rospy.get_time() - self._last_publish_time > 0.5:
                 self._diag_pub.publish(msg)
                 self._last_publish_time = rospy.get_time()
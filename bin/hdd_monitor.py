@@ -45,62 +45,83 @@ import rospy
 import traceback
 import threading
 from threading import Timer
-import sys, os, time
+import sys, os
+import errno
 from time import sleep
-import subprocess
+import fnmatch
+import math
+import re
+import select
 
 import socket
 
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import CachedFile, ExhaustionForecaster, SensorIndex, TempSensorReader, \
+    monotonic_time, read_sysfs_attr
 
 hdd_level_warn = 0.95
 hdd_level_error = 0.99
+hdd_inode_level_warn = 0.95
+hdd_inode_level_error = 0.99
 hdd_temp_warn = 55.0
 hdd_temp_error = 70.0
+forecast_samples = 60
+forecast_horizon = 86400.0
+hdd_fstypes = [ 'ext4', 'xfs', 'btrfs' ]
+hdd_mount_include = []
+hdd_mount_exclude = []
+hdd_statvfs_timeout = 2.0
+hddtemp_fallback = True
+hddtemp_host = 'localhost'
+hddtemp_port = 7634
+hddtemp_timeout = 2.0
+hdd_io_partitions = False
+hdd_io_exclude = [ 'loop*', 'ram*', 'zram*' ]
+hdd_io_util_warn = 0.9
+hdd_io_await_warn = 100.0
+
+# File systems whose statvfs can block on a remote server
+remote_fstypes = set([ 'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph',
+                       'glusterfs', 'sshfs', 'fuse.sshfs', '9p' ])
 
 stat_dict = { 0: 'OK', 1: 'Warning', 2: 'Error' }
 temp_dict = { 0: 'OK', 1: 'Hot', 2: 'Critical Hot' }
 usage_dict = { 0: 'OK', 1: 'Low Disk Space', 2: 'Very Low Disk Space' }
+inode_dict = { 0: 'OK', 1: 'Low Free Inodes', 2: 'Very Low Free Inodes' }
 
 REMOVABLE = ['/dev/sg1', '/dev/sdb'] # Store removable drives so we can ignore if removed
 
 ## Connects to hddtemp daemon to get temp, HDD make.
-def get_hddtemp_data(hostname = 'localhost', port = 7634):
+def get_hddtemp_data(hostname = 'localhost', port = 7634, timeout = 2.0):
     try:
-        hdd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        hdd_sock.connect((hostname, port))
-        sock_data = ''
-        while True:
-            newdat = hdd_sock.recv(1024)
-            if len(newdat) == 0:
-                break
-            sock_data = sock_data + newdat
-        hdd_sock.close()
-
-        sock_vals = sock_data.split('|')
+        hdd_sock = socket.create_connection((hostname, port), timeout)
+        sock_data = bytearray()
+        try:
+            while True:
+                newdat = hdd_sock.recv(4096)
+                if len(newdat) == 0:
+                    break
+                sock_data.extend(newdat)
+        finally:
+            hdd_sock.close()
 
-        # Format of output looks like ' | DRIVE | MAKE | TEMP | ' 
-        idx = 0
+        sock_vals = sock_data.decode('UTF-8', 'replace').split('|')
 
+        # Format of output looks like ' | DRIVE | MAKE | TEMP | UNIT | '
         drives = []
         makes = []
         temps = []
-        while idx + 5 < len(sock_vals):
-            this_drive = sock_vals[idx + 1]
+        for idx in range(0, len(sock_vals) - 5, 5):
             this_make = sock_vals[idx + 2]
-            this_temp = sock_vals[idx + 3]
 
             # Sometimes we get duplicate makes if hard drives are mounted
             # to two different points
             if this_make in makes:
-                idx += 5
                 continue
 
-            drives.append(this_drive)
+            drives.append(sock_vals[idx + 1])
             makes.append(this_make)
-            temps.append(this_temp)
-                        
-            idx += 5
+            temps.append(sock_vals[idx + 3])
 
         return True, drives, makes, temps
     except:
@@ -131,6 +152,259 @@ def update_status_stale(stat, last_update_time):
     stat.values.insert(0, KeyValue(key = 'Update Status', value = stale_status))
     stat.values.insert(1, KeyValue(key = 'Time Since Update', value = str(time_since_update)))
 
+# Spaces and other special characters in mountinfo paths, e.g. \040
+octal_escape_re = re.compile(r'\\([0-7]{3})')
+
+##\brief Index of mounted file systems from /proc/self/mountinfo
+##
+## The file is kept open and polled for POLLPRI, which the kernel raises
+## when the mount table changed, so it is only parsed after a change.
+class MountIndex():
+    def __init__(self, fstypes, include = [], exclude = [], path = '/proc/self/mountinfo'):
+        self._fstypes = set(fstypes)
+        self._include = include
+        self._exclude = exclude
+        self._path = path
+        self._fd = None
+        self._poller = select.poll()
+        self._stale = False
+        self.mounts = []
+
+    def close(self):
+        if self._fd is not None:
+            self._poller.unregister(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    ## Makes the next refresh rebuild mounts even if no change was polled
+    def invalidate(self):
+        self._stale = True
+
+    def _selected(self, mount_pt):
+        if self._include and not [ x for x in self._include if fnmatch.fnmatch(mount_pt, x) ]:
+            return False
+        return not [ x for x in self._exclude if fnmatch.fnmatch(mount_pt, x) ]
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).decode('UTF-8', 'replace')
+
+    ## Rebuilds mounts, a list of (source, mount point, fstype), if the
+    ## mount table changed. Returns True if it was rebuilt.
+    def refresh(self):
+        if self._fd is None:
+            self._fd = os.open(self._path, os.O_RDONLY)
+            self._poller.register(self._fd, select.POLLPRI | select.POLLERR)
+        elif not self._stale and not self._poller.poll(0):
+            return False
+        self._stale = False
+
+        mounts = {}
+        order = []
+        for ln in self._read().split('\n'):
+            # ID parent major:minor root mount_point options [tags] - fstype source options
+            words = ln.split(' - ')
+            if len(words) != 2:
+                continue
+            fields = words[0].split()
+            fs = words[1].split()
+            if len(fields) < 5 or len(fs) < 2:
+                continue
+            mount_pt = octal_escape_re.sub(lambda m: chr(int(m.group(1), 8)), fields[4])
+            if fs[0] not in self._fstypes or fs[1] == 'none' or not self._selected(mount_pt):
+                continue
+            if mount_pt not in mounts:
+                order.append(mount_pt)
+            # Later entries are mounted over earlier ones
+            mounts[mount_pt] = (fs[1], mount_pt, fs[0])
+        self.mounts = [ mounts[x] for x in order ]
+        return True
+
+##\brief Calls os.statvfs, in a worker thread with a timeout for file
+## systems which may hang on a remote server
+class StatvfsCaller():
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._pending = {}
+
+    ## Returns statvfs of mount_pt, None if it timed out or a previous
+    ## call on it is still pending
+    def statvfs(self, mount_pt, fstype):
+        if fstype not in remote_fstypes:
+            return os.statvfs(mount_pt)
+
+        worker = self._pending.get(mount_pt)
+        if worker is not None:
+            if worker.is_alive():
+                return None
+            del self._pending[mount_pt]
+
+        result = []
+        def call():
+            try:
+                result.append(os.statvfs(mount_pt))
+            except OSError as e:
+                result.append(e)
+        worker = threading.Thread(target = call)
+        worker.daemon = True
+        worker.start()
+        worker.join(self._timeout)
+        if worker.is_alive():
+            self._pending[mount_pt] = worker
+            return None
+        if isinstance(result[0], OSError):
+            raise result[0]
+        return result[0]
+
+# Columns of /proc/diskstats after major, minor and device name
+diskstats_fields = dict([ (x, i) for i, x in enumerate([
+    'reads', 'reads_merged', 'sectors_read', 'read_ms',
+    'writes', 'writes_merged', 'sectors_written', 'write_ms',
+    'in_flight', 'io_ms', 'weighted_io_ms',
+    'discards', 'discards_merged', 'sectors_discarded', 'discard_ms' ]) ])
+
+##\brief Block device IO rates from /proc/diskstats deltas
+class DiskStats():
+    def __init__(self, partitions = False, exclude = []):
+        self._file = CachedFile('/proc/diskstats', 16384)
+        self._partitions = partitions
+        self._exclude = exclude
+        self._devices = None
+        self._selected = set()
+        self._last = {}
+        self._last_time = None
+
+    ## Selects devices, only called when the set of devices changed
+    def _select(self, devices):
+        whole_disks = set(os.listdir('/sys/block'))
+        self._selected = set([ x for x in devices
+            if (self._partitions or x in whole_disks) and
+               not [ y for y in self._exclude if fnmatch.fnmatch(x, y) ] ])
+        self._devices = devices
+
+    ## Returns [ (device, { rate name: value }) ] since the last call, rates
+    ## are empty on the first call
+    def sample(self):
+        now = monotonic_time()
+        counters = {}
+        devices = []
+        for ln in self._file.read().split('\n'):
+            words = ln.split()
+            if len(words) < 14:
+                continue
+            devices.append(words[2])
+            if self._devices is None or words[2] in self._selected:
+                counters[words[2]] = [ int(x) for x in words[3:18] ]
+        if devices != self._devices:
+            self._select(devices)
+
+        elapsed = 0
+        if self._last_time is not None:
+            elapsed = now - self._last_time
+        last = self._last
+        self._last = counters
+        self._last_time = now
+
+        f = diskstats_fields
+        rates = []
+        for device in devices:
+            if device not in self._selected or device not in counters:
+                continue
+            if device not in last or elapsed <= 0:
+                rates.append((device, {}))
+                continue
+            # Counters restart when the device is re-added
+            delta = [ max(x - y, 0) for x, y in zip(counters[device], last[device]) ]
+            # Kernels before 4.18 have no discard columns
+            delta.extend([ 0 ]*(len(f) - len(delta)))
+            ios = delta[f['reads']] + delta[f['writes']]
+            rates.append((device, {
+                'read_iops': delta[f['reads']]/elapsed,
+                'write_iops': delta[f['writes']]/elapsed,
+                'read_mbs': delta[f['sectors_read']]*512/1e6/elapsed,
+                'write_mbs': delta[f['sectors_written']]*512/1e6/elapsed,
+                'await': float(delta[f['read_ms']] + delta[f['write_ms']])/ios if ios else 0.0,
+                'util': min(delta[f['io_ms']]/(elapsed*1e3), 1.0),
+                'queue_depth': delta[f['weighted_io_ms']]/(elapsed*1e3),
+                'discard_iops': delta[f['discards']]/elapsed,
+                'discard_mbs': delta[f['sectors_discarded']]*512/1e6/elapsed }))
+        return rates
+
+##\brief Drive temperatures from the drivetemp and nvme hwmon drivers
+##
+## Drives are the 'drive' sensors of a SensorIndex, read through
+## descriptors kept open between calls. The drives are re-indexed only if
+## a hwmon device appears or goes away.
+class DriveTempSensors():
+    def __init__(self, hwmon_root = '/sys/class/hwmon'):
+        self._index = SensorIndex(hwmon_root)
+        self._reader = TempSensorReader()
+        self.drives = []
+
+    def close(self):
+        self._reader.close()
+        self.drives = []
+
+    ## Returns (drive, make) of a drive sensor
+    def _get_drive(self, sensor):
+        device = os.path.join(os.path.dirname(sensor.path), 'device')
+        if sensor.driver == 'drivetemp':
+            # SCSI device of a SATA drive, its block device is below it
+            blocks = os.listdir(os.path.join(device, 'block'))
+            drive = '/dev/' + blocks[0]
+            make = ' '.join([ read_sysfs_attr(os.path.join(device, x)) for x in [ 'vendor', 'model' ] ])
+        else:
+            drive = '/dev/' + os.path.basename(os.path.realpath(device))
+            make = read_sysfs_attr(os.path.join(device, 'model'))
+        return drive, make.strip()
+
+    ## Re-indexes the drives if the set of hwmon devices changed
+    def refresh(self):
+        if not self._index.refresh():
+            return False
+
+        drives = []
+        devices = set()
+        for sensor in self._index.sensors('drive', 'hwmon'):
+            # The first sensor of a device is the drive temperature, NVMe
+            # drives may have more for their controller and flash
+            device = os.path.dirname(sensor.path)
+            if device in devices:
+                continue
+            devices.add(device)
+            try:
+                drive, make = self._get_drive(sensor)
+            except (OSError, IndexError):
+                continue # Device went away while indexing
+            drives.append((drive, make, sensor))
+        self.drives = drives
+        return True
+
+    ## Returns drives, makes and temperatures in degrees as strings
+    def read(self):
+        try:
+            values = [ x[1] for x in self._reader.read([ x[2] for x in self.drives ]) ]
+        except (OSError, IOError):
+            values = [ '' ] * len(self.drives) # Device went away, re-indexed on refresh
+
+        temps = []
+        for value in values:
+            try:
+                temps.append('%d' % (int(value)//1000))
+            except ValueError:
+                temps.append('ERR')
+        return [ x[0] for x in self.drives ], [ x[1] for x in self.drives ], temps
+
+## Formats a size in bytes in G like df -h
+def format_size_g(size):
+    return '%.1fG' % (size/float(2**30))
+
 class hdd_monitor():
     def __init__(self, hostname, diag_hostname):
         self._mutex = threading.Lock()
@@ -140,8 +414,27 @@ class hdd_monitor():
         self._no_temp_warn = rospy.get_param('~no_hdd_temp_warn', False)
         self._hdd_level_warn = rospy.get_param('~hdd_level_warn', hdd_level_warn)
         self._hdd_level_error = rospy.get_param('~hdd_level_error', hdd_level_error)
+        self._hdd_inode_level_warn = rospy.get_param('~hdd_inode_level_warn', hdd_inode_level_warn)
+        self._hdd_inode_level_error = rospy.get_param('~hdd_inode_level_error', hdd_inode_level_error)
+        self._hdd_mount_levels = rospy.get_param('~hdd_mount_levels', {})
         self._hdd_temp_warn = rospy.get_param('~hdd_temp_warn', hdd_temp_warn)
         self._hdd_temp_error = rospy.get_param('~hdd_temp_error', hdd_temp_error)
+        self._forecast_samples = rospy.get_param('~forecast_samples', forecast_samples)
+        self._forecast_horizon = rospy.get_param('~forecast_horizon', forecast_horizon)
+        self._forecasters = {}
+        self._drive_temps = DriveTempSensors()
+        self._hddtemp_fallback = rospy.get_param('~hddtemp_fallback', hddtemp_fallback)
+        self._hddtemp_host = rospy.get_param('~hddtemp_host', hddtemp_host)
+        self._hddtemp_port = rospy.get_param('~hddtemp_port', hddtemp_port)
+        self._hddtemp_timeout = rospy.get_param('~hddtemp_timeout', hddtemp_timeout)
+        self._mounts = MountIndex(rospy.get_param('~hdd_fstypes', hdd_fstypes),
+                                  rospy.get_param('~hdd_mount_include', hdd_mount_include),
+                                  rospy.get_param('~hdd_mount_exclude', hdd_mount_exclude))
+        self._hdd_io_util_warn = rospy.get_param('~hdd_io_util_warn', hdd_io_util_warn)
+        self._hdd_io_await_warn = rospy.get_param('~hdd_io_await_warn', hdd_io_await_warn)
+        self._diskstats = DiskStats(rospy.get_param('~hdd_io_partitions', hdd_io_partitions),
+                                    rospy.get_param('~hdd_io_exclude', hdd_io_exclude))
+        self._statvfs = StatvfsCaller(rospy.get_param('~hdd_statvfs_timeout', hdd_statvfs_timeout))
 
         self._diag_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size = 100)
 
@@ -167,6 +460,14 @@ class hdd_monitor():
         self._usage_stat.name = 'HDD Usage'
         self._usage_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
                                     KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
+
+        self._io_stat = DiagnosticStatus()
+        self._io_stat.level = DiagnosticStatus.ERROR
+        self._io_stat.hardware_id = hostname
+        self._io_stat.name = 'HDD IO'
+        self._io_stat.message = 'No Data'
+        self._io_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
+                                 KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
         self.check_disk_usage()
 
     ## Must have the lock to cancel everything
@@ -190,15 +491,26 @@ class hdd_monitor():
         diag_level = DiagnosticStatus.OK
         diag_message = 'OK'
 
-        temp_ok, drives, makes, temps = get_hddtemp_data()
+        self._drive_temps.refresh()
+        if self._drive_temps.drives:
+            temp_ok = True
+            drives, makes, temps = self._drive_temps.read()
+            diag_strs.append(KeyValue(key = 'Temperature Source', value = 'hwmon'))
+        elif self._hddtemp_fallback:
+            temp_ok, drives, makes, temps = get_hddtemp_data(self._hddtemp_host, self._hddtemp_port,
+                                                             self._hddtemp_timeout)
+            diag_strs.append(KeyValue(key = 'Temperature Source', value = 'hddtemp'))
+        else:
+            temp_ok, drives, makes, temps = False, [], [], []
+            diag_strs.append(KeyValue(key = 'Temperature Source', value = 'None'))
 
         for index in range(0, len(drives)):
             temp = temps[index]
 
-            if not isinstance(temp, str):
+            if isinstance(temp, bytes) and not isinstance(temp, str):
                 tmp_u = temp.decode("UTF-8")
             else:
-                tmp_u = unicode(temp)
+                tmp_u = u'%s' % temp
 
             if not tmp_u.isnumeric() and drives[index] not in REMOVABLE:
                 temp_level = DiagnosticStatus.ERROR
@@ -242,6 +554,57 @@ class hdd_monitor():
             else:
                 self.cancel_timers()
 
+    ##\brief Checks throughput, latency and utilization of block devices
+    def check_io(self):
+        diag_vals = [ KeyValue(key = 'Update Status', value = 'OK' ),
+                      KeyValue(key = 'Time Since Last Update', value = '0' ) ]
+        diag_level = DiagnosticStatus.OK
+        msgs = []
+
+        try:
+            for index, (device, rates) in enumerate(self._diskstats.sample()):
+                diag_vals.append(KeyValue(key = 'Device %d Name' % index, value = device))
+                if not rates:
+                    continue
+                level = DiagnosticStatus.OK
+                if rates['util'] >= self._hdd_io_util_warn:
+                    level = DiagnosticStatus.WARN
+                    msgs.append('High IO Utilization')
+                if rates['await'] >= self._hdd_io_await_warn:
+                    level = DiagnosticStatus.WARN
+                    msgs.append('High IO Latency')
+                diag_level = max(diag_level, level)
+
+                diag_vals.append(KeyValue(key = 'Device %d Read IOPS' % index, value = '%.1f' % rates['read_iops']))
+                diag_vals.append(KeyValue(key = 'Device %d Write IOPS' % index, value = '%.1f' % rates['write_iops']))
+                diag_vals.append(KeyValue(key = 'Device %d Read Throughput' % index, value = '%.3fMB/s' % rates['read_mbs']))
+                diag_vals.append(KeyValue(key = 'Device %d Write Throughput' % index, value = '%.3fMB/s' % rates['write_mbs']))
+                diag_vals.append(KeyValue(key = 'Device %d Await' % index, value = '%.2fms' % rates['await']))
+                diag_vals.append(KeyValue(key = 'Device %d Utilization' % index, value = '%.1f%%' % (rates['util']*100)))
+                diag_vals.append(KeyValue(key = 'Device %d Queue Depth' % index, value = '%.2f' % rates['queue_depth']))
+                diag_vals.append(KeyValue(key = 'Device %d Discard IOPS' % index, value = '%.1f' % rates['discard_iops']))
+                diag_vals.append(KeyValue(key = 'Device %d Discard Throughput' % index, value = '%.3fMB/s' % rates['discard_mbs']))
+                diag_vals.append(KeyValue(key = 'Device %d Status' % index, value = stat_dict[level]))
+        except Exception as e:
+            rospy.logerr(traceback.format_exc())
+            diag_vals.append(KeyValue(key = 'IO Reading', value = 'Exception'))
+            diag_vals.append(KeyValue(key = 'IO Ex', value = traceback.format_exc()))
+            diag_level = DiagnosticStatus.ERROR
+            msgs = [ stat_dict[diag_level] ]
+
+        if msgs:
+            return diag_level, ', '.join(sorted(set(msgs))), diag_vals
+        return diag_level, stat_dict[diag_level], diag_vals
+
+    ## Returns (warn, error, inode warn, inode error) levels of mount_pt,
+    ## overridden per mount point by hdd_mount_levels
+    def get_mount_levels(self, mount_pt):
+        levels = self._hdd_mount_levels.get(mount_pt, {})
+        return (levels.get('warn', self._hdd_level_warn),
+                levels.get('error', self._hdd_level_error),
+                levels.get('inode_warn', self._hdd_inode_level_warn),
+                levels.get('inode_error', self._hdd_inode_level_error))
+
     def check_disk_usage(self):
         if rospy.is_shutdown():
             with self._mutex:
@@ -254,64 +617,129 @@ class hdd_monitor():
         diag_message = 'OK'
 
         try:
-            p = subprocess.Popen(["df", "-Pht", "ext4"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = p.communicate()
-            retcode = p.returncode
-
-            if (retcode == 0 or retcode == 1):
-                diag_vals.append(KeyValue(key = 'Disk Space Reading', value = 'OK'))
-                if sys.version_info.major == 3:
-                    stdout = stdout.decode('UTF-8')
-                rows = stdout.split('\n')
-                del rows[0]
-                row_count = 0
-                
-                for row in rows:
-                    if len(row.split()) < 2:
+            self._mounts.refresh()
+            diag_vals.append(KeyValue(key = 'Disk Space Reading', value = 'OK'))
+            row_count = 0
+            mount_pts = set()
+
+            for name, mount_pt, fstype in self._mounts.mounts:
+                try:
+                    stat = self._statvfs.statvfs(mount_pt, fstype)
+                except OSError as e:
+                    if e.errno in (errno.ENOENT, errno.ESTALE, errno.ENOTCONN):
+                        # Unmounted since the index was built
+                        self._mounts.invalidate()
                         continue
-
-                    if not isinstance(row.split()[0], str):
-                        row.split()[0] = row.split()[0].decode("UTF-8")
-                    
-                    if row.split()[0] == "none":
-                        continue
-
+                    # E.g. EACCES on a FUSE mount of another user
                     row_count += 1
-                    g_available = row.split()[-3]
-                    g_use = row.split()[-2]
-                    name = row.split()[0]
-                    size = row.split()[1]
-                    mount_pt = row.split()[-1]
-
-                    hdd_usage = float(g_use.replace("%", ""))*1e-2
-                    if (hdd_usage < self._hdd_level_warn):
-                        level = DiagnosticStatus.OK
-                    elif (hdd_usage < self._hdd_level_error):
-                        level = DiagnosticStatus.WARN
-                    else:
-                        level = DiagnosticStatus.ERROR
-
                     diag_vals.append(KeyValue(
                             key = 'Disk %d Name' % row_count, value = name))
                     diag_vals.append(KeyValue(
-                            key = 'Disk %d Size' % row_count, value = size))
+                            key = 'Disk %d Status' % row_count, value = stat_dict[DiagnosticStatus.ERROR]))
+                    diag_vals.append(KeyValue(
+                            key = 'Disk %d Mount Point' % row_count, value = mount_pt))
                     diag_vals.append(KeyValue(
-                            key = 'Disk %d Available' % row_count, value = g_available))
+                            key = 'Disk %d Error' % row_count, value = os.strerror(e.errno)))
+                    if DiagnosticStatus.ERROR > diag_level:
+                        diag_level = DiagnosticStatus.ERROR
+                        diag_message = 'Mount Error'
+                    continue
+                row_count += 1
+                if stat is None:
+                    # The worker thread timed out on a remote file system
                     diag_vals.append(KeyValue(
-                            key = 'Disk %d Use' % row_count, value = g_use))
+                            key = 'Disk %d Name' % row_count, value = name))
                     diag_vals.append(KeyValue(
-                            key = 'Disk %d Status' % row_count, value = stat_dict[level]))
+                            key = 'Disk %d Status' % row_count, value = 'Stalled'))
                     diag_vals.append(KeyValue(
                             key = 'Disk %d Mount Point' % row_count, value = mount_pt))
-
-                    diag_level = max(diag_level, level)
-                    diag_message = usage_dict[diag_level]
-
-            else:
-                diag_vals.append(KeyValue(key = 'Disk Space Reading', value = 'Failed'))
-                diag_level = DiagnosticStatus.ERROR
-                diag_message = stat_dict[diag_level]
-
+                    if DiagnosticStatus.WARN > diag_level:
+                        diag_level = DiagnosticStatus.WARN
+                        diag_message = 'Stalled Mount'
+                    continue
+
+                size = stat.f_blocks*stat.f_frsize
+                available = stat.f_bavail*stat.f_frsize
+                used = (stat.f_blocks - stat.f_bfree)*stat.f_frsize
+                reserved = (stat.f_bfree - stat.f_bavail)*stat.f_frsize
+                # Like df, usage is relative to the space available to users
+                hdd_usage = 0.0
+                if used + available > 0:
+                    hdd_usage = float(used)/(used + available)
+                level_warn, level_error, inode_level_warn, inode_level_error = \
+                    self.get_mount_levels(mount_pt)
+                if (hdd_usage < level_warn):
+                    level = DiagnosticStatus.OK
+                elif (hdd_usage < level_error):
+                    level = DiagnosticStatus.WARN
+                else:
+                    level = DiagnosticStatus.ERROR
+                message = usage_dict[level]
+
+                # File systems like btrfs have no fixed inode count and report 0
+                inodes_used = stat.f_files - stat.f_ffree
+                inode_usage = 0.0
+                if stat.f_files > 0:
+                    inode_usage = float(inodes_used)/(inodes_used + stat.f_favail)
+                if inode_usage >= inode_level_error:
+                    inode_level = DiagnosticStatus.ERROR
+                elif inode_usage >= inode_level_warn:
+                    inode_level = DiagnosticStatus.WARN
+                else:
+                    inode_level = DiagnosticStatus.OK
+                if inode_level > level:
+                    level = inode_level
+                    message = inode_dict[inode_level]
+
+                forecaster = self._forecasters.get(mount_pt)
+                if forecaster is None:
+                    forecaster = ExhaustionForecaster(self._forecast_samples)
+                    self._forecasters[mount_pt] = forecaster
+                mount_pts.add(mount_pt)
+                forecaster.add(monotonic_time(), available)
+                time_to_full = forecaster.time_to_exhaustion()
+                forecast_warn = False
+                if time_to_full is not None and time_to_full < self._forecast_horizon and \
+                   level == DiagnosticStatus.OK:
+                    level = DiagnosticStatus.WARN
+                    forecast_warn = True
+
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Name' % row_count, value = name))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Size' % row_count, value = format_size_g(size)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Available' % row_count, value = format_size_g(available)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Use' % row_count, value = '%d%%' % math.ceil(hdd_usage*100)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Reserved' % row_count, value = format_size_g(reserved)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Inodes Used' % row_count, value = str(inodes_used)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Inodes Free' % row_count, value = str(stat.f_favail)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Inode Use' % row_count, value = '%d%%' % math.ceil(inode_usage*100)))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Status' % row_count, value = stat_dict[level]))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Mount Point' % row_count, value = mount_pt))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d File System' % row_count, value = fstype))
+                diag_vals.append(KeyValue(
+                        key = 'Disk %d Time To Full' % row_count,
+                        value = '%.0fs' % time_to_full if time_to_full is not None else 'N/A'))
+
+                if level > diag_level:
+                    diag_level = level
+                    diag_message = message
+                    if forecast_warn:
+                        diag_message = 'Disk Full Forecast'
+
+            # Forget unmounted file systems
+            for mount_pt in list(self._forecasters.keys()):
+                if mount_pt not in mount_pts:
+                    del self._forecasters[mount_pt]
 
         except:
             rospy.logerr(traceback.format_exc())
@@ -322,12 +750,17 @@ class hdd_monitor():
             diag_level = DiagnosticStatus.ERROR
             diag_message = stat_dict[diag_level]
 
+        io_level, io_message, io_vals = self.check_io()
+
         # Update status
         with self._mutex:
             self._last_usage_time = rospy.get_time()
             self._usage_stat.values = diag_vals
             self._usage_stat.message = diag_message
             self._usage_stat.level = diag_level
+            self._io_stat.values = io_vals
+            self._io_stat.message = io_message
+            self._io_stat.level = io_level
             
             if not rospy.is_shutdown():
                 self._usage_timer = threading.Timer(5.0, self.check_disk_usage)
@@ -347,6 +780,8 @@ class hdd_monitor():
               
             update_status_stale(self._usage_stat, self._last_usage_time)
             msg.status.append(self._usage_stat)
+            update_status_stale(self._io_stat, self._last_usage_time)
+            msg.status.append(self._io_stat)
 
             if rospy.get_time() - self._last_publish_time > 0.5:
                 self._diag_pub.publish(msg)
@@ -354,9 +789,6 @@ class hdd_monitor():
 
 
 
-
-##\todo Need to check HDD input/output too using iostat
-
 if __name__ == '__main__':
     hostname = socket.gethostname()
     hostname = hostname.replace('-', '_')
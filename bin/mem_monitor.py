@@ -45,20 +45,49 @@ import rospy
 import traceback
 import threading
 from threading import Timer
-import sys, os, time
+import sys, os
 from time import sleep
-import subprocess
-import string
+import heapq
 
 import socket
 
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import CachedFile, ExhaustionForecaster, monotonic_time
 
 mem_level_warn = 0.95
 mem_level_error = 0.99
+pgmajfault_rate_warn = 1000.0
+swap_rate_warn = 1000.0
+pgscan_direct_rate_warn = 10000.0
+refault_rate_warn = 10000.0
+top_processes_rss_threshold = 4096
+forecast_samples = 60
+forecast_horizon = 3600.0
 
 stat_dict = { 0: 'OK', 1: 'Warning', 2: 'Error' }
 
+# Fields of /proc/meminfo published in addition to the totals
+meminfo_fields = [ ('MemAvailable', 'Available Memory'),
+                   ('Cached', 'Cached Memory'),
+                   ('Dirty', 'Dirty Memory'),
+                   ('Writeback', 'Writeback Memory'),
+                   ('Shmem', 'Shared Memory'),
+                   ('Slab', 'Slab Memory'),
+                   ('SReclaimable', 'Reclaimable Slab Memory') ]
+
+# Rates published from /proc/vmstat, values of all present fields are summed
+vmstat_rates = [ ('pgmajfault', 'Major Page Faults', [ 'pgmajfault' ]),
+                 ('pswpin', 'Swap In', [ 'pswpin' ]),
+                 ('pswpout', 'Swap Out', [ 'pswpout' ]),
+                 ('pgscan_direct', 'Direct Reclaim Scan', [ 'pgscan_direct' ]),
+                 ('pgsteal_direct', 'Direct Reclaim Steal', [ 'pgsteal_direct' ]),
+                 ('pgscan_kswapd', 'Kswapd Scan', [ 'pgscan_kswapd' ]),
+                 ('pgsteal_kswapd', 'Kswapd Steal', [ 'pgsteal_kswapd' ]),
+                 ('oom_kill', 'OOM Kills', [ 'oom_kill' ]),
+                 # Split into anon and file since Linux 5.9
+                 ('workingset_refault', 'Workingset Refaults',
+                  [ 'workingset_refault', 'workingset_refault_anon', 'workingset_refault_file' ]) ]
+
 def update_status_stale(stat, last_update_time):
     time_since_update = rospy.get_time() - last_update_time
 
@@ -85,6 +114,133 @@ def update_status_stale(stat, last_update_time):
     stat.values.insert(1, KeyValue(key = 'Time Since Update', value = str(time_since_update)))
     
 
+## Returns all fields of /proc/meminfo as integers, sizes are in kB
+def parse_meminfo(data):
+    info = {}
+    for ln in data.split('\n'):
+        words = ln.split()
+        if len(words) >= 2:
+            info[words[0].rstrip(':')] = int(words[1])
+    return info
+
+##\brief Rates per second of /proc/vmstat counters from deltas between calls
+class VMStatRates():
+    def __init__(self, path = '/proc/vmstat'):
+        self._file = CachedFile(path, 16384)
+        self._last_counters = None
+        self._last_time = None
+
+    ## Returns { name: rate } for the vmstat_rates names, rates are None for
+    ## the first call and for counters missing on this kernel
+    def sample(self):
+        now = monotonic_time()
+        fields = {}
+        for ln in self._file.read().split('\n'):
+            words = ln.split()
+            if len(words) == 2:
+                fields[words[0]] = words[1]
+
+        counters = {}
+        for name, label, field_names in vmstat_rates:
+            present = [ int(fields[x]) for x in field_names if x in fields ]
+            if present:
+                counters[name] = sum(present)
+
+        rates = dict([ (x[0], None) for x in vmstat_rates ])
+        if self._last_counters is not None and now > self._last_time:
+            for name, value in counters.items():
+                if name in self._last_counters:
+                    rates[name] = max(value - self._last_counters[name], 0)/(now - self._last_time)
+
+        self._last_counters = counters
+        self._last_time = now
+        return rates
+
+##\brief Tracks the processes using most memory
+##
+## The cheap /proc/[pid]/statm is read for every process on each update,
+## smaps_rollup with PSS and swap only for processes whose RSS changed by
+## more than rss_threshold kB since it was last read. The start time from
+## /proc/[pid]/stat is kept as well, so a reused pid is read as a new
+## process.
+class ProcessMemoryTracker():
+    def __init__(self, num_processes = 5, rss_threshold = 4096, proc_root = '/proc'):
+        self._num_processes = num_processes
+        self._rss_threshold = rss_threshold
+        self._proc_root = proc_root
+        self._page_kb = os.sysconf('SC_PAGE_SIZE')//1024
+        # pid -> [rss, rss at last rollup, pss, swap, name, start time]
+        self._procs = {}
+
+    def _read(self, pid, name, size):
+        fd = os.open('%s/%s/%s' % (self._proc_root, pid, name), os.O_RDONLY)
+        try:
+            return os.read(fd, size)
+        finally:
+            os.close(fd)
+
+    ## Returns start time of the process in jiffies after boot
+    def _get_start_time(self, pid):
+        stat = self._read(pid, 'stat', 1024)
+        # Name may contain spaces and parentheses
+        return int(stat[stat.rfind(b')') + 2:].split()[19])
+
+    ## Returns ROS node name if given on the command line, name of the
+    ## executable otherwise
+    def _get_name(self, pid):
+        args = self._read(pid, 'cmdline', 4096).decode('UTF-8', 'replace').split('\0')
+        for arg in args:
+            if arg.startswith('__name:='):
+                return arg[len('__name:='):]
+        if args[0]:
+            return os.path.basename(args[0].split()[0])
+        return self._read(pid, 'comm', 64).decode('UTF-8', 'replace').strip()
+
+    ## Returns (pss, swap) in kB, (None, None) if smaps_rollup is not readable
+    def _read_rollup(self, pid):
+        pss = None
+        swap = None
+        try:
+            for ln in self._read(pid, 'smaps_rollup', 4096).decode().split('\n'):
+                if ln.startswith('Pss:'):
+                    pss = int(ln.split()[1])
+                elif ln.startswith('Swap:'):
+                    swap = int(ln.split()[1])
+        except (OSError, IOError):
+            pass # No permission or kernel without smaps_rollup
+        return pss, swap
+
+    def update(self):
+        procs = {}
+        for pid in os.listdir(self._proc_root):
+            if not pid.isdigit():
+                continue
+            try:
+                rss = int(self._read(pid, 'statm', 128).split()[1])*self._page_kb
+                if rss == 0:
+                    continue # Kernel thread
+
+                start_time = self._get_start_time(pid)
+                proc = self._procs.get(pid)
+                if proc is None or proc[5] != start_time:
+                    pss, swap = self._read_rollup(pid)
+                    proc = [ rss, rss, pss, swap, self._get_name(pid), start_time ]
+                elif abs(rss - proc[1]) > self._rss_threshold:
+                    pss, swap = self._read_rollup(pid)
+                    proc[1:4] = [ rss, pss, swap ]
+                proc[0] = rss
+                procs[pid] = proc
+            except (OSError, IOError, IndexError):
+                continue # Process exited
+        self._procs = procs
+
+    ## Returns list of (pid, name, rss, pss, swap) of the top processes by
+    ## PSS, or RSS if PSS is unknown, all sizes in kB
+    def top(self):
+        top_procs = heapq.nlargest(self._num_processes, self._procs.items(),
+                                   key = lambda x: x[1][2] if x[1][2] is not None else x[1][0])
+        return [ (pid, proc[4], proc[0], proc[2], proc[3]) for pid, proc in top_procs ]
+
 class MemMonitor():
     def __init__(self, hostname, diag_hostname):
         self._diag_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size = 100)
@@ -93,9 +249,22 @@ class MemMonitor():
 
         self._mem_level_warn = rospy.get_param('~mem_level_warn', mem_level_warn)
         self._mem_level_error = rospy.get_param('~mem_level_error', mem_level_error)
+        self._pgmajfault_rate_warn = rospy.get_param('~pgmajfault_rate_warn', pgmajfault_rate_warn)
+        self._swap_rate_warn = rospy.get_param('~swap_rate_warn', swap_rate_warn)
+        self._pgscan_direct_rate_warn = rospy.get_param('~pgscan_direct_rate_warn', pgscan_direct_rate_warn)
+        self._refault_rate_warn = rospy.get_param('~refault_rate_warn', refault_rate_warn)
+
+        self._check_top_processes = rospy.get_param('~check_top_processes', False)
+        self._num_top_processes = rospy.get_param('~num_top_processes', 5)
+        self._top_processes_rss_threshold = rospy.get_param('~top_processes_rss_threshold',
+                                                            top_processes_rss_threshold)
 
         self._usage_timer = None
-        
+        self._meminfo_file = CachedFile('/proc/meminfo', 8192)
+        self._vmstat_rates = VMStatRates()
+        self._forecast_horizon = rospy.get_param('~forecast_horizon', forecast_horizon)
+        self._forecaster = ExhaustionForecaster(rospy.get_param('~forecast_samples', forecast_samples))
+
         self._usage_stat = DiagnosticStatus()
         self._usage_stat.name = 'Memory Usage'
         self._usage_stat.level = 1
@@ -104,6 +273,18 @@ class MemMonitor():
         self._usage_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
                                     KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
 
+        self._process_stat = DiagnosticStatus()
+        self._process_stat.name = 'Memory Top Processes'
+        self._process_stat.level = DiagnosticStatus.OK
+        self._process_stat.hardware_id = hostname
+        self._process_stat.message = 'No Data'
+        self._process_stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
+                                      KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
+        self._process_tracker = None
+        if self._check_top_processes:
+            self._process_tracker = ProcessMemoryTracker(self._num_top_processes,
+                                                         self._top_processes_rss_threshold)
+
         self._last_usage_time = 0
         self._last_publish_time = 0
 
@@ -123,35 +304,24 @@ class MemMonitor():
         mem_dict = { 0: 'OK', 1: 'Low Memory', 2: 'Very Low Memory' }
 
         try:
-            p = subprocess.Popen('free -tm',
-                                stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE, shell = True)
-            stdout, stderr = p.communicate()
-            retcode = p.returncode
-
-            if retcode != 0:
-                values.append(KeyValue(key = "\"free -tm\" Call Error", value = str(retcode)))
-                return DiagnosticStatus.ERROR, values
-
-            if sys.version_info.major == 3:
-                stdout = stdout.decode('UTF-8')
-            
-            rows = stdout.split('\n')
-            data = rows[1].split()
-            total_mem_physical = data[1]
-            used_mem_physical = data[2]
-            free_mem_physical = data[3]
-            data = rows[1].split()
-            used_mem_wo_buffers = data[5]
-            free_mem_wo_buffers = data[6]
-            data = rows[2].split()
-            total_mem_swap = data[1]
-            used_mem_swap = data[2]
-            free_mem_swap = data[3]
-            data = rows[3].split()
-            total_mem = data[1]
-            used_mem = data[2]
-            free_mem = data[3]
+            info = parse_meminfo(self._meminfo_file.read())
+
+            # MemAvailable is missing before Linux 3.14
+            available = info.get('MemAvailable',
+                                 info['MemFree'] + info['Buffers'] + info['Cached'])
+            buffers_cache = info['Buffers'] + info['Cached'] + info.get('SReclaimable', 0)
+
+            total_mem_physical = info['MemTotal']
+            used_mem_physical = total_mem_physical - info['MemFree'] - buffers_cache
+            free_mem_physical = info['MemFree']
+            used_mem_wo_buffers = total_mem_physical - available
+            free_mem_wo_buffers = available
+            total_mem_swap = info['SwapTotal']
+            used_mem_swap = total_mem_swap - info['SwapFree']
+            free_mem_swap = info['SwapFree']
+            total_mem = total_mem_physical + total_mem_swap
+            used_mem = used_mem_physical + used_mem_swap
+            free_mem = free_mem_physical + free_mem_swap
 
             level = DiagnosticStatus.OK
             mem_usage = float(used_mem_wo_buffers)/float(total_mem_physical)
@@ -163,26 +333,98 @@ class MemMonitor():
                 level = DiagnosticStatus.ERROR
 
             values.append(KeyValue(key = 'Memory Status', value = mem_dict[level]))
-            values.append(KeyValue(key = 'Total Memory (Physical)', value = total_mem_physical+"M"))
-            values.append(KeyValue(key = 'Used Memory (Physical)', value = used_mem_physical+"M"))
-            values.append(KeyValue(key = 'Free Memory (Physical)', value = free_mem_physical+"M"))
-            values.append(KeyValue(key = 'Used Memory (Physical w/o Buffers)', value = used_mem_wo_buffers+"M"))
-            values.append(KeyValue(key = 'Free Memory (Physical w/o Buffers)', value = free_mem_wo_buffers+"M"))
-            values.append(KeyValue(key = 'Total Memory (Swap)', value = total_mem_swap+"M"))
-            values.append(KeyValue(key = 'Used Memory (Swap)', value = used_mem_swap+"M"))
-            values.append(KeyValue(key = 'Free Memory (Swap)', value = free_mem_swap+"M"))
-            values.append(KeyValue(key = 'Total Memory', value = total_mem+"M"))
-            values.append(KeyValue(key = 'Used Memory', value = used_mem+"M"))
-            values.append(KeyValue(key = 'Free Memory', value = free_mem+"M"))
+            values.append(KeyValue(key = 'Total Memory (Physical)', value = '%dM' % (total_mem_physical/1024)))
+            values.append(KeyValue(key = 'Used Memory (Physical)', value = '%dM' % (used_mem_physical/1024)))
+            values.append(KeyValue(key = 'Free Memory (Physical)', value = '%dM' % (free_mem_physical/1024)))
+            values.append(KeyValue(key = 'Used Memory (Physical w/o Buffers)', value = '%dM' % (used_mem_wo_buffers/1024)))
+            values.append(KeyValue(key = 'Free Memory (Physical w/o Buffers)', value = '%dM' % (free_mem_wo_buffers/1024)))
+            values.append(KeyValue(key = 'Total Memory (Swap)', value = '%dM' % (total_mem_swap/1024)))
+            values.append(KeyValue(key = 'Used Memory (Swap)', value = '%dM' % (used_mem_swap/1024)))
+            values.append(KeyValue(key = 'Free Memory (Swap)', value = '%dM' % (free_mem_swap/1024)))
+            values.append(KeyValue(key = 'Total Memory', value = '%dM' % (total_mem/1024)))
+            values.append(KeyValue(key = 'Used Memory', value = '%dM' % (used_mem/1024)))
+            values.append(KeyValue(key = 'Free Memory', value = '%dM' % (free_mem/1024)))
+            values.append(KeyValue(key = 'Memory Usage', value = '%.2f%%' % (mem_usage*1e2)))
 
             msg = mem_dict[level]
+            self._forecaster.add(monotonic_time(), available)
+            time_to_exhaustion = self._forecaster.time_to_exhaustion()
+            if time_to_exhaustion is None:
+                values.append(KeyValue(key = 'Memory Time To Exhaustion', value = 'N/A'))
+            else:
+                values.append(KeyValue(key = 'Memory Time To Exhaustion', value = '%.0fs' % time_to_exhaustion))
+                if time_to_exhaustion < self._forecast_horizon and level == DiagnosticStatus.OK:
+                    level = DiagnosticStatus.WARN
+                    msg = 'Memory Exhaustion Forecast'
+
+            for field, name in meminfo_fields:
+                if field in info:
+                    values.append(KeyValue(key = name, value = '%dM' % (info[field]/1024)))
+            if info.get('HugePages_Total', 0) > 0:
+                values.append(KeyValue(key = 'HugePages Total', value = str(info['HugePages_Total'])))
+                values.append(KeyValue(key = 'HugePages Free', value = str(info['HugePages_Free'])))
+                values.append(KeyValue(key = 'HugePages Size', value = '%dK' % info['Hugepagesize']))
         except Exception as e:
             rospy.logerr(traceback.format_exc())
             msg = 'Memory Usage Check Error'
             values.append(KeyValue(key = msg, value = str(e)))
             level = DiagnosticStatus.ERROR
 
-        return level, mem_dict[level], values
+        return level, msg, values
+
+    ##\brief Checks paging and reclaim rates to catch thrashing early
+    def check_vmstat(self):
+        values = []
+        level = DiagnosticStatus.OK
+        msgs = []
+
+        try:
+            rates = self._vmstat_rates.sample()
+            swap_rate = (rates['pswpin'] or 0.0) + (rates['pswpout'] or 0.0)
+
+            for name, warn in [ ('pgmajfault', self._pgmajfault_rate_warn),
+                                ('pgscan_direct', self._pgscan_direct_rate_warn),
+                                ('workingset_refault', self._refault_rate_warn) ]:
+                if rates[name] is not None and rates[name] > warn:
+                    level = DiagnosticStatus.WARN
+                    msgs.append('Memory Thrashing')
+            if swap_rate > self._swap_rate_warn:
+                level = DiagnosticStatus.WARN
+                msgs.append('Memory Thrashing')
+            if rates['oom_kill']:
+                level = DiagnosticStatus.ERROR
+                msgs.append('OOM Kill')
+
+            for name, label, field_names in vmstat_rates:
+                if rates[name] is not None:
+                    values.append(KeyValue(key = label, value = '%.1f/s' % rates[name]))
+
+        except Exception as e:
+            rospy.logerr(traceback.format_exc())
+            msgs = [ 'Paging Check Error' ]
+            values.append(KeyValue(key = 'Paging Check Error', value = str(e)))
+            level = DiagnosticStatus.ERROR
+
+        return level, ', '.join(sorted(set(msgs))), values
+
+    ##\brief Lists processes with the highest memory usage
+    def check_top_processes(self):
+        vals = []
+        try:
+            self._process_tracker.update()
+            for index, (pid, name, rss, pss, swap) in enumerate(self._process_tracker.top()):
+                vals.append(KeyValue(key = 'Process %d Name' % index, value = name))
+                vals.append(KeyValue(key = 'Process %d PID' % index, value = pid))
+                vals.append(KeyValue(key = 'Process %d RSS' % index, value = '%dM' % (rss/1024)))
+                if pss is not None:
+                    vals.append(KeyValue(key = 'Process %d PSS' % index, value = '%dM' % (pss/1024)))
+                    vals.append(KeyValue(key = 'Process %d Swap' % index, value = '%dM' % ((swap or 0)/1024)))
+        except Exception as e:
+            rospy.logerr(traceback.format_exc())
+            vals.append(KeyValue(key = 'Top Processes Exception', value = str(e)))
+            return DiagnosticStatus.ERROR, vals
+
+        return DiagnosticStatus.OK, vals
 
     def check_usage(self):
         if rospy.is_shutdown():
@@ -202,13 +444,30 @@ class MemMonitor():
             diag_msgs.append(mem_msg)
         diag_level = max(diag_level, mem_level)
 
+        # Check paging and reclaim
+        vm_level, vm_msg, vm_vals = self.check_vmstat()
+        diag_vals.extend(vm_vals)
+        if vm_level > 0:
+            diag_msgs.append(vm_msg)
+        diag_level = max(diag_level, vm_level)
+
         if diag_msgs and diag_level > 0:
             usage_msg = ', '.join(set(diag_msgs))
         else:
             usage_msg = stat_dict[diag_level]
 
+        if self._process_tracker:
+            process_level, process_vals = self.check_top_processes()
+
         # Update status
         with self._mutex:
+            if self._process_tracker:
+                self._process_stat.level = process_level
+                self._process_stat.message = stat_dict[process_level]
+                self._process_stat.values = [ KeyValue(key = 'Update Status', value = 'OK' ),
+                                              KeyValue(key = 'Time Since Last Update', value = 0 ) ]
+                self._process_stat.values.extend(process_vals)
+
             self._last_usage_time = rospy.get_time()
             self._usage_stat.level = diag_level
             self._usage_stat.values = diag_vals
@@ -230,6 +489,10 @@ class MemMonitor():
             msg.header.stamp = rospy.get_rostime()
             msg.status.append(self._usage_stat)
 
+            if self._process_tracker:
+                update_status_stale(self._process_stat, self._last_usage_time)
+                msg.status.append(self._process_stat)
+
             if rospy.get_time() - self._last_publish_time > 0.5:
                 self._diag_pub.publish(msg)
                 self._last_publish_time = rospy.get_time()
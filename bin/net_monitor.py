@@ -47,16 +47,30 @@ import threading
 from threading import Timer
 import sys, os, time
 from time import sleep
-import subprocess
-import string
 import re
+import fnmatch
+import struct
 
 import socket
 
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import CachedFile, monotonic_time
 
 net_level_warn = 0.95
 net_capacity = 128
+net_include = []
+net_exclude = [ 'lo' ]
+net_backend = 'procfs'
+
+# (section, counter, name, default warn rate per second) of the transport
+# health counters in /proc/net/snmp and /proc/net/netstat
+transport_counters = [
+  ('Tcp', 'RetransSegs', 'TCP Retransmits', 100.0),
+  ('TcpExt', 'TCPTimeouts', 'TCP Timeouts', 10.0),
+  ('TcpExt', 'ListenOverflows', 'TCP Listen Overflows', 1.0),
+  ('TcpExt', 'ListenDrops', 'TCP Listen Drops', 1.0),
+  ('Udp', 'RcvbufErrors', 'UDP Receive Buffer Errors', 1.0),
+  ('Udp', 'InErrors', 'UDP Input Errors', 1.0) ]
 
 stat_dict = {0: 'OK', 1: 'Warning', 2: 'Error'}
 
@@ -83,32 +97,274 @@ def update_status_stale(stat, last_update_time):
   stat.values.insert(1, KeyValue(key = 'Time Since Update',
     value = str(time_since_update)))
 
-def get_sys_net_stat(iface, syst):
-  cmd = 'cat /sys/class/net/%s/statistics/%s' %(iface, syst)
-  p = subprocess.Popen(cmd,
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE, shell = True)
-  stdout, stderr = p.communicate()
-  if sys.version_info.major == 3:
-    stdout = stdout.decode("UTF-8")
-  return (p.returncode, stdout.strip())
-
-def get_sys_net(iface, syst):
-  cmd = 'cat /sys/class/net/%s/%s' %(iface, syst)
-  p = subprocess.Popen(cmd,
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE, shell = True)
-  stdout, stderr = p.communicate()
-  if sys.version_info.major == 3:
-    stdout = stdout.decode("UTF-8")
-  return (p.returncode, stdout.strip())
+## Returns contents of a sysfs attribute of iface, or None if it cannot be read
+def read_sys_net(iface, attr):
+  try:
+    with open('/sys/class/net/%s/%s' % (iface, attr)) as f:
+      return f.read().strip()
+  except (OSError, IOError):
+    return None
+
+## Returns { iface: counters } of /proc/net/dev, with counters indexed
+## as in net_dev_fields. Lines of interfaces for which select returns
+## False are skipped before their counters are parsed.
+def parse_net_dev(data, select = None):
+  counters = {}
+  for ln in data.split('\n')[2:]:
+    if ':' not in ln:
+      continue
+    iface, fields = ln.split(':', 1)
+    iface = iface.strip()
+    if select is None or select(iface):
+      counters[iface] = [ int(x) for x in fields.split() ]
+  return counters
+
+## Compiles interface name patterns, which are globs or, if prefixed
+## with 're:', regular expressions
+def compile_patterns(patterns):
+  if isinstance(patterns, str):
+    patterns = [ patterns ]
+  return [ re.compile(x[3:]) if x.startswith('re:') else
+           re.compile(fnmatch.translate(x)) for x in patterns ]
+
+def match_patterns(iface, patterns):
+  for pattern in patterns:
+    if pattern.match(iface):
+      return True
+  return False
+
+# Receive and transmit columns of /proc/net/dev
+net_dev_fields = dict([ (x, i) for i, x in enumerate([
+  'rx_bytes', 'rx_packets', 'rx_errors', 'rx_dropped', 'rx_fifo', 'rx_frame',
+  'rx_compressed', 'rx_multicast', 'tx_bytes', 'tx_packets', 'tx_errors',
+  'tx_dropped', 'tx_fifo', 'collisions', 'tx_carrier', 'tx_compressed' ]) ])
+
+# rtnetlink constants from linux/netlink.h, linux/rtnetlink.h and linux/if_link.h
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTMGRP_LINK = 0x1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_OPERSTATE = 16
+IFLA_STATS64 = 23
+
+nlmsghdr = struct.Struct('=IHHII')
+ifinfomsg = struct.Struct('=BxHiII')
+rtattr = struct.Struct('=HH')
+rtnl_link_stats64 = struct.Struct('=23Q')
+
+operstates = [ 'unknown', 'notpresent', 'down', 'lowerlayerdown',
+               'testing', 'dormant', 'up' ]
+
+# Index of each net_dev_fields counter in struct rtnl_link_stats64
+stats64_fields = [ 2, 0, 4, 6, 14, 13, 21, 8, 3, 1, 5, 7, 18, 9, 17, 22 ]
+
+##\brief Returns (iface, counters, operstate, mtu) of a RTM_NEWLINK
+## message, with counters indexed as in net_dev_fields. Returns None
+## if select returns False for the interface.
+def parse_rtm_link(data, offset, end, select = None):
+  offset += nlmsghdr.size + ifinfomsg.size
+  attrs = {}
+  while offset + rtattr.size <= end:
+    length, attr_type = rtattr.unpack_from(data, offset)
+    if length < rtattr.size:
+      break
+    attrs[attr_type] = (offset + rtattr.size, offset + length)
+    offset += (length + 3) & ~3
+
+  if IFLA_IFNAME not in attrs:
+    return None
+  start, stop = attrs[IFLA_IFNAME]
+  iface = data[start:stop].split(b'\0')[0].decode('UTF-8', 'replace')
+  if select is not None and not select(iface):
+    return None
+
+  counters = None
+  if IFLA_STATS64 in attrs:
+    stats = rtnl_link_stats64.unpack_from(data, attrs[IFLA_STATS64][0])
+    counters = [ stats[x] for x in stats64_fields ]
+  operstate = 'unknown'
+  if IFLA_OPERSTATE in attrs:
+    state = struct.unpack_from('=B', data, attrs[IFLA_OPERSTATE][0])[0]
+    if state < len(operstates):
+      operstate = operstates[state]
+  mtu = None
+  if IFLA_MTU in attrs:
+    mtu = str(struct.unpack_from('=I', data, attrs[IFLA_MTU][0])[0])
+  return iface, counters, operstate, mtu
+
+##\brief Route netlink socket, either for link dumps or, if groups is
+## RTMGRP_LINK, for link change notifications
+class RTNetlink():
+  def __init__(self, groups = 0):
+    self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+      self._sock.bind((0, groups))
+    except (OSError, socket.error):
+      self._sock.close()
+      raise
+    self._pid = self._sock.getsockname()[0]
+    self._seq = 0
+    self._dump_seq = None
+
+  def close(self):
+    self._sock.close()
+
+  def settimeout(self, timeout):
+    self._sock.settimeout(timeout)
+
+  ## Yields (type, seq, pid, data, offset, end) of each message in the
+  ## next datagram
+  def _recv(self):
+    data = self._sock.recv(65536)
+    offset = 0
+    while offset + nlmsghdr.size <= len(data):
+      length, msg_type, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+      if length < nlmsghdr.size:
+        break
+      yield msg_type, seq, pid, data, offset, offset + length
+      offset += (length + 3) & ~3
+
+  ## Reads the rest of a dump which was aborted, the kernel rejects new
+  ## dumps with EBUSY until it is done
+  def _finish_dump(self):
+    while self._dump_seq is not None:
+      for msg_type, seq, pid, data, offset, end in self._recv():
+        if seq == self._dump_seq and msg_type in (NLMSG_DONE, NLMSG_ERROR):
+          self._dump_seq = None
+          break
+
+  ##\brief Returns { iface: (counters, operstate, mtu) } of all links
+  ## in a single RTM_GETLINK dump
+  def dump(self, select = None):
+    self._finish_dump()
+    self._seq += 1
+    request = ifinfomsg.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+    self._sock.send(nlmsghdr.pack(nlmsghdr.size + len(request), RTM_GETLINK,
+      NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0) + request)
+    self._dump_seq = self._seq
+
+    links = {}
+    while True:
+      for msg_type, seq, pid, data, offset, end in self._recv():
+        if seq != self._seq or pid != self._pid:
+          continue # Left over from an earlier request
+        if msg_type == NLMSG_DONE:
+          self._dump_seq = None
+          return links
+        if msg_type == NLMSG_ERROR:
+          self._dump_seq = None
+          error = struct.unpack_from('=i', data, offset + nlmsghdr.size)[0]
+          raise OSError(-error, os.strerror(-error))
+        if msg_type == RTM_NEWLINK:
+          link = parse_rtm_link(data, offset, end, select)
+          if link is not None and link[1] is not None:
+            links[link[0]] = link[1:]
+
+  ##\brief Returns [ (iface, operstate) ] of the next link notifications,
+  ## removed interfaces are reported as 'notpresent'
+  def recv_events(self):
+    events = []
+    for msg_type, seq, pid, data, offset, end in self._recv():
+      if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+        link = parse_rtm_link(data, offset, end)
+        if link is not None:
+          if msg_type == RTM_DELLINK:
+            events.append((link[0], 'notpresent'))
+          else:
+            events.append((link[0], link[2]))
+    return events
+
+##\brief Reads counters from files of header and value line pairs like
+## /proc/net/snmp and /proc/net/netstat
+##
+## The position of each counter is looked up only when the header lines
+## change, each read then just splits the value lines.
+class ProcNetCounters():
+  def __init__(self, paths, counters):
+    self._files = [ CachedFile(x) for x in paths ]
+    self._counters = counters
+    self._headers = None
+    self._index = []
+
+  def _build_index(self, lines):
+    positions = {}
+    for i in range(0, len(lines) - 1, 2):
+      names = lines[i].split()
+      section = names[0].rstrip(':')
+      for j, name in enumerate(names[1:]):
+        positions[(section, name)] = (i + 1, j + 1)
+    self._index = [ positions.get(x) for x in self._counters ]
+
+  ## Returns the counters as integers, None for counters not found
+  def read(self):
+    lines = []
+    for f in self._files:
+      try:
+        lines.extend([ x for x in f.read().split('\n') if x ])
+      except (OSError, IOError):
+        pass
+    headers = lines[0::2]
+    if headers != self._headers:
+      self._build_index(lines)
+      self._headers = headers
+
+    rows = {}
+    counters = []
+    for position in self._index:
+      if position is None:
+        counters.append(None)
+        continue
+      row, column = position
+      if row not in rows:
+        rows[row] = lines[row].split()
+      counters.append(int(rows[row][column]))
+    return counters
 
 class NetMonitor():
   def __init__(self, hostname, diag_hostname):
     self._diag_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size = 100)
     self._mutex = threading.Lock()
+    self._check_mutex = threading.Lock()
     self._net_level_warn = rospy.get_param('~net_level_warn', net_level_warn)
     self._net_capacity = rospy.get_param('~net_capacity', net_capacity)
+    self._net_capacity_override = rospy.get_param('~net_capacity_override', {})
+    self._net_include = compile_patterns(rospy.get_param('~net_include', net_include))
+    self._net_exclude = compile_patterns(rospy.get_param('~net_exclude', net_exclude))
+    self._net_aggregate = [ (x, compile_patterns(y)) for x, y in
+                            sorted(rospy.get_param('~net_aggregate', {}).items()) ]
+    self._rows = {}
+    self._net_dev = CachedFile('/proc/net/dev')
+    self._netlink = None
+    self._link_events = None
+    self._link_states = {}
+    if rospy.get_param('~net_backend', net_backend) == 'netlink':
+      try:
+        self._netlink = RTNetlink()
+        self._link_events = RTNetlink(RTMGRP_LINK)
+      except (OSError, socket.error) as e:
+        rospy.logwarn('Unable to open netlink socket, using /proc/net/dev: %s' % e)
+        if self._netlink is not None:
+          self._netlink.close()
+          self._netlink = None
+    self._last_counters = {}
+    self._last_sample_time = None
+    self._ifaces = []
+    self._operstate = {}
+    self._mtu = {}
+    self._link = {}
+    self._transport = ProcNetCounters([ '/proc/net/snmp', '/proc/net/netstat' ],
+      [ (x[0], x[1]) for x in transport_counters ])
+    self._transport_warn = [ rospy.get_param('~%s_rate_warn' %
+      x[2].lower().replace(' ', '_'), x[3]) for x in transport_counters ]
+    self._last_transport = None
+    self._last_transport_time = None
     self._usage_timer = None
     self._usage_stat = DiagnosticStatus()
     self._usage_stat.name = 'Network Usage'
@@ -119,80 +375,222 @@ class NetMonitor():
                                value = 'No Data' ),
                                KeyValue(key = 'Time Since Last Update',
                                value = 'N/A') ]
+    self._transport_stat = DiagnosticStatus()
+    self._transport_stat.name = 'Network Transport'
+    self._transport_stat.level = 1
+    self._transport_stat.hardware_id = hostname
+    self._transport_stat.message = 'No Data'
+    self._transport_stat.values = [KeyValue(key = 'Update Status',
+                                   value = 'No Data' ),
+                                   KeyValue(key = 'Time Since Last Update',
+                                   value = 'N/A') ]
     self._last_usage_time = 0
     self._last_publish_time = 0
     self.check_usage()
+    if self._link_events is not None:
+      self._link_thread = threading.Thread(target = self.watch_links)
+      self._link_thread.daemon = True
+      self._link_thread.start()
 
   def cancel_timers(self):
     if self._usage_timer:
       self._usage_timer.cancel()
 
+  ##\brief Reads static attributes and opens state files, called only
+  ## when the set of interfaces changed
+  def update_interfaces(self, ifaces):
+    for iface in self._ifaces:
+      if iface not in ifaces:
+        self._operstate.pop(iface).close()
+        del self._mtu[iface]
+        self._link.pop(iface, None)
+    for iface in ifaces:
+      if iface not in self._operstate:
+        self._operstate[iface] = CachedFile('/sys/class/net/%s/operstate' % iface, 64)
+        self._mtu[iface] = read_sys_net(iface, 'mtu')
+    self._ifaces = ifaces
+
+  ##\brief Returns (capacity in MBit/s, duplex) of iface, read from sysfs
+  ## only if the link state changed since the last call
+  def get_link(self, iface, state):
+    if iface in self._link and self._link[iface][0] == state:
+      return self._link[iface][1:]
+
+    duplex = read_sys_net(iface, 'duplex') or 'unknown'
+    if iface in self._net_capacity_override:
+      capacity = float(self._net_capacity_override[iface])
+    else:
+      # Virtual and disconnected interfaces report -1 or fail with EINVAL
+      speed = read_sys_net(iface, 'speed')
+      try:
+        capacity = float(speed)
+      except (TypeError, ValueError):
+        capacity = -1
+      if capacity <= 0:
+        capacity = float(self._net_capacity)
+    self._link[iface] = (state, capacity, duplex)
+    return capacity, duplex
+
+  ##\brief Waits for link notifications and checks the network
+  ## immediately if a reported interface changed its operstate
+  def watch_links(self):
+    self._link_events.settimeout(1.0)
+    while not rospy.is_shutdown():
+      try:
+        events = self._link_events.recv_events()
+      except socket.timeout:
+        continue
+      except (OSError, socket.error):
+        rospy.logerr(traceback.format_exc())
+        time.sleep(1.0)
+        continue
+      changed = False
+      for iface, state in events:
+        if self.get_row(iface) == iface and self._link_states.get(iface) != state:
+          changed = True
+      if changed:
+        self.check_usage()
+        self.publish_stats()
+    self._link_events.close()
+
+  ##\brief Returns the row iface is reported in, which is the interface
+  ## itself, the name of an aggregate or None if it is filtered out.
+  ## Rules are only matched once per interface name.
+  def get_row(self, iface):
+    if iface in self._rows:
+      return self._rows[iface]
+    row = None
+    if not match_patterns(iface, self._net_exclude):
+      for name, patterns in self._net_aggregate:
+        if match_patterns(iface, patterns):
+          row = name
+          break
+      else:
+        if not self._net_include or match_patterns(iface, self._net_include):
+          row = iface
+    self._rows[iface] = row
+    return row
+
   def check_network(self):
     values = []
     net_dict = {0: 'OK', 1: 'High Network Usage', 2: 'Network Down', 3: 'Call Error'}
+    level = DiagnosticStatus.OK
     try:
-      p = subprocess.Popen('ifstat -q -S 1 1',
-                           stdout = subprocess.PIPE,
-                           stderr = subprocess.PIPE, shell = True)
-      stdout, stderr = p.communicate()
-      retcode = p.returncode
-      if retcode == 3:
-        values.append(KeyValue(key = "\"ifstat -q -S 1 1\" Call Error",
-          value = str(retcode)))
-        return DiagnosticStatus.ERROR, net_dict[3], values
-      
-      if sys.version_info.major == 3:
-        stdout = stdout.decode("UTF-8")
-      rows = stdout.split('\n')
-      data = rows[0].split()
-      ifaces = []
-      for i in range(0, len(data)):
-        ifaces.append(data[i])
-      data = rows[2].split()
-      kb_in = []
-      kb_out = []
-      for i in range(0, len(data), 2):
-        kb_in.append(data[i])
-        kb_out.append(data[i + 1])
-      level = DiagnosticStatus.OK
-      for i in range(0, len(ifaces)):
+      now = monotonic_time()
+      seen = set()
+      def select(iface):
+        seen.add(iface)
+        return self.get_row(iface) is not None
+      links = None
+      if self._netlink is not None:
+        links = self._netlink.dump(select)
+        counters = dict([ (x, y[0]) for x, y in links.items() ])
+      else:
+        counters = parse_net_dev(self._net_dev.read(), select)
+      if len(self._rows) > len(seen):
+        # Forget rule matches of removed interfaces
+        self._rows = dict([ (x, self._rows[x]) for x in seen ])
+      rows = {}
+      for iface in counters:
+        rows.setdefault(self._rows[iface], []).append(iface)
+      aggregates = set([ x for x, y in self._net_aggregate ])
+      ifaces = sorted([ x for x in rows if x not in aggregates ])
+      if links is None and ifaces != self._ifaces:
+        self.update_interfaces(ifaces)
+      elif links is not None and len(self._link) > len(ifaces):
+        # Forget link attributes of removed interfaces, netlink does not
+        # need update_interfaces
+        self._link = dict([ x for x in self._link.items() if x[0] in rows ])
+      link_states = {}
+
+      elapsed = 0
+      if self._last_sample_time is not None:
+        elapsed = now - self._last_sample_time
+      last_counters = self._last_counters
+      self._last_counters = counters
+      self._last_sample_time = now
+
+      rx_bytes = net_dev_fields['rx_bytes']
+      tx_bytes = net_dev_fields['tx_bytes']
+      rx_packets = net_dev_fields['rx_packets']
+      tx_packets = net_dev_fields['tx_packets']
+      for row in ifaces + sorted([ x for x in rows if x in aggregates ]):
+        current = [ 0 ]*len(net_dev_fields)
+        rates = [ 0.0 ]*len(net_dev_fields)
+        for iface in rows[row]:
+          current = [ x + y for x, y in zip(current, counters[iface]) ]
+          last = last_counters.get(iface)
+          if last is not None and elapsed > 0:
+            # Counters restart when the device is re-registered
+            rates = [ r + max(x - y, 0)/elapsed for r, x, y in
+                      zip(rates, counters[iface], last) ]
+
         values.append(KeyValue(key = 'Interface Name',
-          value = ifaces[i]))
-        (retcode, cmd_out) = get_sys_net(ifaces[i], 'operstate')
-        if retcode == 0:
-          values.append(KeyValue(key = 'State', value = cmd_out))
-          ifacematch = re.match('eth[0-9]+', ifaces[i])
-          if ifacematch and (cmd_out == 'down' or cmd_out == 'dormant'):
+          value = row))
+        state = None
+        if row in aggregates:
+          values.append(KeyValue(key = 'Aggregated Interfaces',
+            value = str(len(rows[row]))))
+        elif links is not None:
+          state = links[row][1]
+        else:
+          try:
+            state = self._operstate[row].read().strip()
+          except (OSError, IOError):
+            pass
+        link_states[row] = state
+        if state is not None:
+          values.append(KeyValue(key = 'State', value = state))
+          ifacematch = re.match('eth[0-9]+', row)
+          if ifacematch and (state == 'down' or state == 'dormant'):
             level = DiagnosticStatus.ERROR
+        mbit_in = rates[rx_bytes] / 1024 / 1024 * 8
+        mbit_out = rates[tx_bytes] / 1024 / 1024 * 8
         values.append(KeyValue(key = 'Input Traffic',
-          value = str(float(kb_in[i]) / 1024 * 8) + " (MBit/s)"))
+          value = str(mbit_in) + " (MBit/s)"))
         values.append(KeyValue(key = 'Output Traffic',
-          value = str(float(kb_out[i]) / 1024 * 8) + " (MBit/s)"))
-        net_usage_in = float(kb_in[i]) / 1024 * 8 / self._net_capacity
-        net_usage_out = float(kb_out[i]) / 1024 * 8 / self._net_capacity
+          value = str(mbit_out) + " (MBit/s)"))
+        if row in aggregates:
+          capacity = float(self._net_capacity_override.get(row, self._net_capacity))
+          duplex = None
+        else:
+          capacity, duplex = self.get_link(row, state)
+        if duplex == 'half':
+          # Both directions share the medium
+          net_usage_in = (mbit_in + mbit_out) / capacity
+          net_usage_out = net_usage_in
+        else:
+          net_usage_in = mbit_in / capacity
+          net_usage_out = mbit_out / capacity
         if net_usage_in > self._net_level_warn or\
           net_usage_out > self._net_level_warn:
-          level = DiagnosticStatus.WARN
-        (retcode, cmd_out) = get_sys_net(ifaces[i], 'mtu')
-        if retcode == 0:
-          values.append(KeyValue(key = 'MTU', value = cmd_out))
-        (retcode, cmd_out) = get_sys_net_stat(ifaces[i], 'rx_bytes')
-        if retcode == 0:
-          values.append(KeyValue(key = 'Input Percentage',
-            value = str(round(float(net_usage_in * 100), 2)) + "%"))
-        (retcode, cmd_out) = get_sys_net_stat(ifaces[i], 'tx_bytes')
-        if retcode == 0:
-          values.append(KeyValue(key = 'Output percentage',
-            value = str(round(float(net_usage_out * 100), 2)) + "%"))
-        (retcode, cmd_out) = get_sys_net_stat(ifaces[i], 'collisions')
-        if retcode == 0:
-          values.append(KeyValue(key = 'Collisions', value = cmd_out))
-        (retcode, cmd_out) = get_sys_net_stat(ifaces[i], 'rx_errors')
-        if retcode == 0:
-          values.append(KeyValue(key = 'Rx Errors', value = cmd_out))
-        (retcode, cmd_out) = get_sys_net_stat(ifaces[i], 'tx_errors')
-        if retcode == 0:
-          values.append(KeyValue(key = 'Tx Errors', value = cmd_out))
+          level = max(level, DiagnosticStatus.WARN)
+        if links is not None and row in links:
+          mtu = links[row][2]
+        else:
+          mtu = self._mtu.get(row)
+        if mtu is not None:
+          values.append(KeyValue(key = 'MTU', value = mtu))
+        values.append(KeyValue(key = 'Input Percentage',
+          value = str(round(float(net_usage_in * 100), 2)) + "%"))
+        values.append(KeyValue(key = 'Output percentage',
+          value = str(round(float(net_usage_out * 100), 2)) + "%"))
+        values.append(KeyValue(key = 'Collisions',
+          value = str(current[net_dev_fields['collisions']])))
+        values.append(KeyValue(key = 'Rx Errors',
+          value = str(current[net_dev_fields['rx_errors']])))
+        values.append(KeyValue(key = 'Tx Errors',
+          value = str(current[net_dev_fields['tx_errors']])))
+        values.append(KeyValue(key = 'Link Speed',
+          value = str(capacity) + " (MBit/s)"))
+        if duplex is not None:
+          values.append(KeyValue(key = 'Duplex', value = duplex))
+        values.append(KeyValue(key = 'Input Packets',
+          value = '%.1f (packets/s)' % rates[rx_packets]))
+        values.append(KeyValue(key = 'Output Packets',
+          value = '%.1f (packets/s)' % rates[tx_packets]))
+      # Replaced as a whole, so states of removed interfaces are dropped
+      self._link_states = link_states
     except Exception as e:
       rospy.logerr(traceback.format_exc())
       msg = 'Network Usage Check Error'
@@ -200,11 +598,52 @@ class NetMonitor():
       level = DiagnosticStatus.ERROR
     return level, net_dict[level], values
 
+  ##\brief Checks rates of TCP and UDP error counters
+  def check_transport(self):
+    values = []
+    level = DiagnosticStatus.OK
+    msgs = []
+    try:
+      now = monotonic_time()
+      counters = self._transport.read()
+      last = self._last_transport
+      elapsed = 0
+      if last is not None:
+        elapsed = now - self._last_transport_time
+      self._last_transport = counters
+      self._last_transport_time = now
+
+      for i in range(0, len(transport_counters)):
+        name = transport_counters[i][2]
+        if counters[i] is None:
+          continue
+        rate = 0.0
+        if last is not None and last[i] is not None and elapsed > 0:
+          rate = max(counters[i] - last[i], 0) / elapsed
+        if rate > self._transport_warn[i]:
+          level = DiagnosticStatus.WARN
+          msgs.append('High ' + name)
+        values.append(KeyValue(key = name, value = '%.2f/s' % rate))
+        values.append(KeyValue(key = name + ' Total', value = str(counters[i])))
+    except Exception as e:
+      rospy.logerr(traceback.format_exc())
+      msgs = [ 'Network Transport Check Error' ]
+      values.append(KeyValue(key = 'Network Transport Check Error', value = str(e)))
+      level = DiagnosticStatus.ERROR
+    if msgs:
+      return level, ', '.join(msgs), values
+    return level, stat_dict[level], values
+
   def check_usage(self):
     if rospy.is_shutdown():
       with self._mutex:
         self.cancel_timers()
       return
+    # Link notifications check outside of the timer
+    with self._check_mutex:
+      self._check_usage()
+
+  def _check_usage(self):
     diag_level = 0
     diag_vals = [KeyValue(key = 'Update Status', value = 'OK'),
                  KeyValue(key = 'Time Since Last Update', value = 0)]
@@ -218,12 +657,18 @@ class NetMonitor():
       usage_msg = ', '.join(set(diag_msgs))
     else:
       usage_msg = stat_dict[diag_level]
+    transport_level, transport_msg, transport_vals = self.check_transport()
     with self._mutex:
       self._last_usage_time = rospy.get_time()
       self._usage_stat.level = diag_level
       self._usage_stat.values = diag_vals
       self._usage_stat.message = usage_msg
+      self._transport_stat.level = transport_level
+      self._transport_stat.values = [KeyValue(key = 'Update Status', value = 'OK'),
+        KeyValue(key = 'Time Since Last Update', value = 0)] + transport_vals
+      self._transport_stat.message = transport_msg
       if not rospy.is_shutdown():
+        self.cancel_timers()
         self._usage_timer = threading.Timer(5.0, self.check_usage)
         self._usage_timer.start()
       else:
@@ -232,9 +677,11 @@ class NetMonitor():
   def publish_stats(self):
     with self._mutex:
       update_status_stale(self._usage_stat, self._last_usage_time)
+      update_status_stale(self._transport_stat, self._last_usage_time)
       msg = DiagnosticArray()
       msg.header.stamp = rospy.get_rostime()
       msg.status.append(self._usage_stat)
+      msg.status.append(self._transport_stat)
       if rospy.get_time() - self._last_publish_time > 0.5:
         self._diag_pub.publish(msg)
         self._last_publish_time = rospy.get_time()
@@ -37,18 +37,170 @@
 ############################################################################
 
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import monotonic_time
 
 import sys
 import rospy
 import socket
-from subprocess import Popen, PIPE
+import select
+import struct
+import math
+import threading
 
 import time
 
-import re
-
 NAME = 'ntp_monitor'
 
+# Seconds from the NTP era (1900) to the Unix epoch
+NTP_EPOCH_OFFSET = 2208988800
+# LI, VN and Mode bytes plus stratum through transmit timestamp, RFC 4330
+ntp_packet = struct.Struct('!BBBb11I')
+
+## Converts a time in seconds since the Unix epoch to NTP seconds and fraction
+def time_to_ntp(t):
+    t += NTP_EPOCH_OFFSET
+    return int(t) & 0xffffffff, int((t - int(t))*2**32) & 0xffffffff
+
+def ntp_to_time(seconds, fraction):
+    return seconds - NTP_EPOCH_OFFSET + float(fraction)/2**32
+
+## Returns (offset, delay) in seconds from a SNTP reply, or raises
+## ValueError if it is not a valid reply to the request sent at t1
+def parse_sntp_reply(data, request_ntp, t1, t4):
+    if len(data) < ntp_packet.size:
+        raise ValueError('Short reply')
+    fields = ntp_packet.unpack_from(data)
+    leap, mode = fields[0] >> 6, fields[0] & 0x7
+    stratum = fields[1]
+    if mode not in (4, 5) or leap == 3 or not 0 < stratum < 16:
+        raise ValueError('Unsynchronized server, stratum %d' % stratum)
+    if (fields[9], fields[10]) != request_ntp:
+        raise ValueError('Reply does not match request')
+
+    t2 = ntp_to_time(fields[11], fields[12])
+    t3 = ntp_to_time(fields[13], fields[14])
+    return ((t2 - t1) + (t3 - t4))/2, (t4 - t1) - (t3 - t2)
+
+##\brief Resolves server names in worker threads, with a deadline for
+## resolvers which may hang
+##
+## A server whose lookup is still pending from a previous query is not
+## looked up again until that lookup returns.
+class AddressResolver():
+    def __init__(self):
+        self._pending = {}
+
+    ## Returns { server: address info, socket error or None if the lookup
+    ## did not finish before deadline on monotonic_time }
+    def resolve(self, servers, port, deadline):
+        results = {}
+        workers = []
+        for server in set(servers):
+            worker = self._pending.get(server)
+            if worker is not None:
+                if worker.is_alive():
+                    results[server] = None
+                    continue
+                del self._pending[server]
+
+            result = []
+            def call(server = server, result = result):
+                try:
+                    result.append(socket.getaddrinfo(server, port, 0, socket.SOCK_DGRAM)[0])
+                except (socket.error, OSError) as e:
+                    result.append(e)
+            worker = threading.Thread(target = call)
+            worker.daemon = True
+            worker.start()
+            workers.append((server, worker, result))
+
+        for server, worker, result in workers:
+            worker.join(max(deadline - monotonic_time(), 0.0))
+            if worker.is_alive():
+                self._pending[server] = worker
+                results[server] = None
+            else:
+                results[server] = result[0]
+        return results
+
+##\brief Queries all servers concurrently with SNTP (RFC 4330)
+##
+## Resolves the server names concurrently, sends one request per server
+## and waits for the replies with select, so the whole query, including
+## name resolution, takes at most timeout seconds. Returns a list of
+## (server, offset, delay, error) with offset and delay in seconds, in the
+## order of servers. Only t1 and t4 of the exchange use the wall clock.
+def sntp_query(servers, timeout = 2.0, port = 123, resolver = None):
+    if resolver is None:
+        resolver = AddressResolver()
+    deadline = monotonic_time() + timeout
+    addrs = resolver.resolve(servers, port, deadline)
+
+    results = [ (None, None, 'No reply') ] * len(servers)
+    pending = {}
+    try:
+        for index, server in enumerate(servers):
+            addr_info = addrs[server]
+            if addr_info is None:
+                results[index] = (None, None, 'Name resolution timed out')
+                continue
+            if isinstance(addr_info, Exception):
+                results[index] = (None, None, str(addr_info))
+                continue
+            try:
+                family, socktype, proto, name, addr = addr_info
+                sock = socket.socket(family, socktype, proto)
+            except (socket.error, OSError) as e:
+                results[index] = (None, None, str(e))
+                continue
+            try:
+                sock.connect(addr)
+                t1 = time.time()
+                request_ntp = time_to_ntp(t1)
+                # Client mode 3, version 4, only the transmit timestamp is set
+                sock.send(ntp_packet.pack(0x23, 0, 0, 0, *([ 0 ]*9 + list(request_ntp))))
+            except (socket.error, OSError) as e:
+                sock.close()
+                results[index] = (None, None, str(e))
+                continue
+            pending[sock] = (index, request_ntp, t1)
+
+        while pending:
+            remaining = deadline - monotonic_time()
+            if remaining <= 0:
+                break
+            readable = select.select(list(pending.keys()), [], [], remaining)[0]
+            for sock in readable:
+                index, request_ntp, t1 = pending[sock]
+                try:
+                    data = sock.recv(1024)
+                    t4 = time.time()
+                    offset, delay = parse_sntp_reply(data, request_ntp, t1, t4)
+                    results[index] = (offset, delay, None)
+                except ValueError as e:
+                    results[index] = (None, None, str(e))
+                    continue # A matching reply may still arrive
+                except (socket.error, OSError) as e:
+                    results[index] = (None, None, str(e))
+                del pending[sock]
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+
+    return [ (x,) + y for x, y in zip(servers, results) ]
+
+## Returns median and jitter, the RMS deviation from the median, of offsets
+def get_offset_stats(offsets):
+    offsets = sorted(offsets)
+    n = len(offsets)
+    if n % 2:
+        median = offsets[n//2]
+    else:
+        median = (offsets[n//2 - 1] + offsets[n//2])/2.0
+    jitter = math.sqrt(sum([ (x - median)**2 for x in offsets ])/n)
+    return median, jitter
+
 def ntp_monitor(offset=500, self_offset=500, diag_hostname = None, error_offset = 5000000):
     pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size = 100)
     rospy.init_node(NAME, anonymous=True)
@@ -58,15 +210,24 @@ def ntp_monitor(offset=500, self_offset=500, diag_hostname = None, error_offset
         diag_hostname = hostname
 
     ntp_hostname = rospy.get_param('~reference_host', 'ntp.ubuntu.com')
+    ntp_hostnames = []
+    for host in rospy.get_param('~reference_hosts', [ ntp_hostname ]):
+        # A server listed twice would be weighted twice in the offset
+        if host not in ntp_hostnames:
+            ntp_hostnames.append(host)
     offset = rospy.get_param('~offset_tolerance', 500)
     error_offset = rospy.get_param('~error_offset_tolerance', 5000000)
+    # Public servers should not be polled more often than every 15 seconds
+    poll_interval = max(rospy.get_param('~poll_interval', 64.0), 15.0)
+    query_timeout = rospy.get_param('~query_timeout', 2.0)
 
     stat = DiagnosticStatus()
     stat.level = 0
-    stat.name = "NTP offset from "+ diag_hostname + " to " + ntp_hostname
+    stat.name = "NTP offset from "+ diag_hostname + " to " + ", ".join(ntp_hostnames)
     stat.message = "OK"
     stat.hardware_id = hostname
     stat.values = []
+    resolver = AddressResolver()
 
 #    self_stat = DiagnosticStatus()
 #    self_stat.level = DiagnosticStatus.OK
@@ -75,43 +236,46 @@ def ntp_monitor(offset=500, self_offset=500, diag_hostname = None, error_offset
 #    self_stat.hardware_id = hostname
 #    self_stat.values = []
 
+    last_query_time = None
     while not rospy.is_shutdown():
-        for st,host,off in [(stat,ntp_hostname,offset)]:
-            try:
-                p = Popen(["ntpdate", "-q", host], stdout=PIPE, stdin=PIPE, stderr=PIPE)
-                res = p.wait()
-                (o,e) = p.communicate()
-            except OSError as e:
-                if e.errno == 4:
-                    break #ctrl-c interrupt
+        if last_query_time is None or monotonic_time() - last_query_time >= poll_interval:
+            last_query_time = monotonic_time()
+            for st,hosts,off in [(stat,ntp_hostnames,offset)]:
+                results = sntp_query(hosts, query_timeout, resolver = resolver)
+                server_values = []
+                for index, (host, server_offset, delay, error) in enumerate(results):
+                    server_values.append(KeyValue("Server %d" % index, host))
+                    if error is None:
+                        server_values.append(KeyValue("Server %d Offset (us)" % index, str(server_offset*1e6)))
+                        server_values.append(KeyValue("Server %d Delay (us)" % index, str(delay*1e6)))
+                    else:
+                        server_values.append(KeyValue("Server %d Error" % index, error))
+
+                offsets = [ x[1] for x in results if x[3] is None ]
+                if offsets:
+                    measured_offset, jitter = get_offset_stats(offsets)
+                    measured_offset *= 1e6
+                    st.level = DiagnosticStatus.OK
+                    st.message = "OK"
+                    st.values = [ KeyValue("Offset (us)", str(measured_offset)),
+                                  KeyValue("Jitter (us)", str(jitter*1e6)),
+                                  KeyValue("Offset tolerance (us)", str(off)),
+                                  KeyValue("Offset tolerance (us) for Error", str(error_offset)) ]
+
+                    if (abs(measured_offset) > off):
+                        st.level = DiagnosticStatus.WARN
+                        st.message = "NTP Offset Too High"
+                    if (abs(measured_offset) > error_offset):
+                        st.level = DiagnosticStatus.ERROR
+                        st.message = "NTP Offset Too High"
+
                 else:
-                    raise
-            if (res == 0):
-                if sys.version_info.major == 3:
-                    o = o.decode("UTF-8")
-                
-                measured_offset = float(re.search("offset (.*),", o).group(1))*1000000
-                st.level = DiagnosticStatus.OK
-                st.message = "OK"
-                st.values = [ KeyValue("Offset (us)", str(measured_offset)),
-                              KeyValue("Offset tolerance (us)", str(off)),
-                              KeyValue("Offset tolerance (us) for Error", str(error_offset)) ]
-
-                if (abs(measured_offset) > off):
-                    st.level = DiagnosticStatus.WARN
-                    st.message = "NTP Offset Too High"
-                if (abs(measured_offset) > error_offset):
                     st.level = DiagnosticStatus.ERROR
-                    st.message = "NTP Offset Too High"
-
-            else:
-                st.level = DiagnosticStatus.ERROR
-                st.message = "Error Running ntpdate. Returned %d" % res
-                st.values = [ KeyValue("Offset (us)", "N/A"),
-                              KeyValue("Offset tolerance (us)", str(off)),
-                              KeyValue("Offset tolerance (us) for Error", str(error_offset)),
-                              KeyValue("Output", o),
-                              KeyValue("Errors", e) ]
+                    st.message = "No Reply From NTP Servers"
+                    st.values = [ KeyValue("Offset (us)", "N/A"),
+                                  KeyValue("Offset tolerance (us)", str(off)),
+                                  KeyValue("Offset tolerance (us) for Error", str(error_offset)) ]
+                st.values.extend(server_values)
 
 
         msg = DiagnosticArray()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+############################################################################
+#    Copyright (C) 2009, Willow Garage, Inc.                               #
+#    Copyright (C) 2013 by Ralf Kaestner                                   #
+#    ralf.kaestner@gmail.com                                               #
+#    Copyright (C) 2013 by Jerome Maye                                     #
+#    jerome.maye@mavt.ethz.ch                                              #
+#                                                                          #
+#    All rights reserved.                                                  #
+#                                                                          #
+#    Redistribution and use in source and binary forms, with or without    #
+#    modification, are permitted provided that the following conditions    #
+#    are met:                                                              #
+#                                                                          #
+#    1. Redistributions of source code must retain the above copyright     #
+#       notice, this list of conditions and the following disclaimer.      #
+#                                                                          #
+#    2. Redistributions in binary form must reproduce the above copyright  #
+#       notice, this list of conditions and the following disclaimer in    #
+#       the documentation and/or other materials provided with the         #
+#       distribution.                                                      #
+#                                                                          #
+#    3. The name of the copyright holders may be used to endorse or        #
+#       promote products derived from this software without specific       #
+#       prior written permission.                                          #
+#                                                                          #
+#    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS   #
+#    "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT     #
+#    LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS     #
+#    FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE        #
+#    COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,  #
+#    INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,  #
+#    BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;      #
+#    LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER      #
+#    CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT    #
+#    LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN     #
+#    ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE       #
+#    POSSIBILITY OF SUCH DAMAGE.                                           #
+############################################################################
+
+
+from __future__ import with_statement
+
+import rospy
+
+import traceback
+import threading
+from threading import Timer
+import sys, os
+import select
+
+import socket
+
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from system_monitor.util import CachedFile, monotonic_time
+
+psi_some_warn = 10.0
+psi_some_error = 40.0
+psi_full_warn = 5.0
+psi_full_error = 20.0
+psi_trigger_stall_us = 0
+psi_trigger_window_us = 2000000
+
+stat_dict = { 0: 'OK', 1: 'Warning', 2: 'Error' }
+resource_dict = { 'cpu': 'CPU', 'memory': 'Memory', 'io': 'IO' }
+
+def update_status_stale(stat, last_update_time):
+    time_since_update = rospy.get_time() - last_update_time
+
+    stale_status = 'OK'
+    if time_since_update > 20 and time_since_update <= 35:
+        stale_status = 'Lagging'
+        if stat.level == DiagnosticStatus.OK:
+            stat.message = stale_status
+        elif stat.message.find(stale_status) < 0:
+            stat.message = ', '.join([stat.message, stale_status])
+        stat.level = max(stat.level, DiagnosticStatus.WARN)
+    if time_since_update > 35:
+        stale_status = 'Stale'
+        if stat.level == DiagnosticStatus.OK:
+            stat.message = stale_status
+        elif stat.message.find(stale_status) < 0:
+            stat.message = ', '.join([stat.message, stale_status])
+        stat.level = max(stat.level, DiagnosticStatus.ERROR)
+
+
+    stat.values.pop(0)
+    stat.values.pop(0)
+    stat.values.insert(0, KeyValue(key = 'Update Status', value = stale_status))
+    stat.values.insert(1, KeyValue(key = 'Time Since Update', value = str(time_since_update)))
+
+## Returns { 'some': { 'avg10': .., 'avg60': .., 'avg300': .., 'total': .. },
+## 'full': { .. } } from the contents of a /proc/pressure file
+def parse_pressure(data):
+    pressure = {}
+    for ln in data.split('\n'):
+        words = ln.split()
+        if not words:
+            continue
+        values = {}
+        for word in words[1:]:
+            name, value = word.split('=')
+            values[name] = int(value) if name == 'total' else float(value)
+        pressure[words[0]] = values
+    return pressure
+
+class PSIMonitor():
+    def __init__(self, hostname, diag_hostname):
+        self._diag_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size = 100)
+
+        self._mutex = threading.Lock()
+        self._check_mutex = threading.Lock()
+
+        self._psi_some_warn = rospy.get_param('~psi_some_warn', psi_some_warn)
+        self._psi_some_error = rospy.get_param('~psi_some_error', psi_some_error)
+        self._psi_full_warn = rospy.get_param('~psi_full_warn', psi_full_warn)
+        self._psi_full_error = rospy.get_param('~psi_full_error', psi_full_error)
+        self._psi_trigger_stall_us = rospy.get_param('~psi_trigger_stall_us', psi_trigger_stall_us)
+        self._psi_trigger_window_us = rospy.get_param('~psi_trigger_window_us', psi_trigger_window_us)
+
+        self._usage_timer = None
+        self._trigger_thread = None
+        self._resources = [ x for x in [ 'cpu', 'memory', 'io' ]
+                            if os.path.exists('/proc/pressure/%s' % x) ]
+
+        self._files = {}
+        self._last_totals = {}
+        self._events = {}
+        self._stats = {}
+        for resource in self._resources:
+            self._files[resource] = CachedFile('/proc/pressure/%s' % resource, 256)
+            self._events[resource] = 0
+
+            stat = DiagnosticStatus()
+            stat.name = 'Pressure Stall %s' % resource_dict[resource]
+            stat.level = 1
+            stat.hardware_id = hostname
+            stat.message = 'No Data'
+            stat.values = [ KeyValue(key = 'Update Status', value = 'No Data' ),
+                            KeyValue(key = 'Time Since Last Update', value = 'N/A') ]
+            self._stats[resource] = stat
+
+        if not self._resources:
+            rospy.logwarn('No /proc/pressure files found, kernel may not support PSI.')
+
+        self._last_usage_time = 0
+        self._last_publish_time = 0
+
+        # Start checking everything
+        if self._psi_trigger_stall_us > 0:
+            self.start_triggers()
+        self.check_usage()
+
+    ## Must have the lock to cancel everything
+    def cancel_timers(self):
+        if self._usage_timer:
+            self._usage_timer.cancel()
+
+    ##\brief Registers PSI triggers and waits for stall events
+    ##
+    ## A trigger fires if tasks were stalled for psi_trigger_stall_us
+    ## within psi_trigger_window_us, see Documentation/accounting/psi.rst
+    def start_triggers(self):
+        trigger = 'some %d %d' % (self._psi_trigger_stall_us, self._psi_trigger_window_us)
+        poller = select.poll()
+        trigger_fds = {}
+        for resource in self._resources:
+            try:
+                fd = os.open('/proc/pressure/%s' % resource, os.O_RDWR | os.O_NONBLOCK)
+                os.write(fd, (trigger + '\0').encode())
+            except OSError as e:
+                rospy.logwarn('Unable to register PSI trigger for %s: %s' % (resource, e))
+                continue
+            poller.register(fd, select.POLLPRI)
+            trigger_fds[fd] = resource
+
+        if trigger_fds:
+            self._trigger_thread = threading.Thread(target = self.wait_triggers,
+                                                    args = (poller, trigger_fds))
+            self._trigger_thread.daemon = True
+            self._trigger_thread.start()
+
+    def wait_triggers(self, poller, trigger_fds):
+        try:
+            while not rospy.is_shutdown() and trigger_fds:
+                for fd, event in poller.poll(1000):
+                    resource = trigger_fds[fd]
+                    if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                        rospy.logerr('PSI trigger for %s failed.' % resource)
+                        poller.unregister(fd)
+                        os.close(trigger_fds.pop(fd))
+                        continue
+
+                    with self._mutex:
+                        self._events[resource] += 1
+                    self.check_resource(resource)
+                    self.publish_stats(force = True)
+        finally:
+            for fd in trigger_fds:
+                os.close(fd)
+
+    ##\brief Checks stall averages and total stall time of a resource
+    ##
+    ## Stall events counted since the last reset are reported, with
+    ## reset_events the counter is reset in the same step.
+    def check_pressure(self, resource, reset_events = False):
+        values = []
+        level = DiagnosticStatus.OK
+
+        pressure_dict = { 0: 'OK', 1: 'High Pressure', 2: 'Very High Pressure' }
+
+        try:
+            now = monotonic_time()
+            pressure = parse_pressure(self._files[resource].read())
+
+            last_time, last_totals = self._last_totals.get(resource, (None, {}))
+            self._last_totals[resource] = (now, dict([ (x, pressure[x]['total']) for x in pressure ]))
+
+            for kind, warn, error in [ ('some', self._psi_some_warn, self._psi_some_error),
+                                       ('full', self._psi_full_warn, self._psi_full_error) ]:
+                if kind not in pressure:
+                    continue
+                avgs = pressure[kind]
+
+                if avgs['avg10'] >= error:
+                    level = max(level, DiagnosticStatus.ERROR)
+                elif avgs['avg10'] >= warn:
+                    level = max(level, DiagnosticStatus.WARN)
+
+                stall = 0.0
+                if last_time is not None and now > last_time and kind in last_totals:
+                    stall = (avgs['total'] - last_totals[kind])*1e-3/(now - last_time)
+
+                name = kind.capitalize()
+                values.append(KeyValue(key = '%s avg10' % name, value = '%.2f%%' % avgs['avg10']))
+                values.append(KeyValue(key = '%s avg60' % name, value = '%.2f%%' % avgs['avg60']))
+                values.append(KeyValue(key = '%s avg300' % name, value = '%.2f%%' % avgs['avg300']))
+                values.append(KeyValue(key = '%s Stall Time' % name, value = '%.2fms/s' % stall))
+
+            with self._mutex:
+                events = self._events[resource]
+                if reset_events:
+                    self._events[resource] = 0
+            values.append(KeyValue(key = 'Stall Events', value = str(events)))
+            if events > 0:
+                level = max(level, DiagnosticStatus.WARN)
+
+        except Exception as e:
+            rospy.logerr(traceback.format_exc())
+            values.append(KeyValue(key = 'Pressure Check Error', value = str(e)))
+            level = DiagnosticStatus.ERROR
+            return level, 'Pressure Check Error', values
+
+        return level, pressure_dict[level], values
+
+    def check_resource(self, resource, reset_events = False):
+        # Called from the timer and the trigger thread
+        with self._check_mutex:
+            level, msg, vals = self.check_pressure(resource, reset_events)
+        diag_vals = [ KeyValue(key = 'Update Status', value = 'OK' ),
+                      KeyValue(key = 'Time Since Last Update', value = 0 ) ]
+        diag_vals.extend(vals)
+
+        with self._mutex:
+            stat = self._stats[resource]
+            stat.level = level
+            stat.message = msg
+            stat.values = diag_vals
+
+    def check_usage(self):
+        if rospy.is_shutdown():
+            with self._mutex:
+                self.cancel_timers()
+            return
+
+        # Stall events are reported until the next cycle
+        for resource in self._resources:
+            self.check_resource(resource, reset_events = True)
+
+        with self._mutex:
+            self._last_usage_time = rospy.get_time()
+
+            if not rospy.is_shutdown():
+                self._usage_timer = threading.Timer(5.0, self.check_usage)
+                self._usage_timer.start()
+            else:
+                self.cancel_timers()
+
+    def publish_stats(self, force = False):
+        with self._mutex:
+            msg = DiagnosticArray()
+            msg.header.stamp = rospy.get_rostime()
+
+            # Update everything with last update times
+            for resource in self._resources:
+                update_status_stale(self._stats[resource], self._last_usage_time)
+                msg.status.append(self._stats[resource])
+
+            if force or rospy.get_time() - self._last_publish_time > 0.5:
+                self._diag_pub.publish(msg)
+                self._last_publish_time = rospy.get_time()
+
+
+if __name__ == '__main__':
+    hostname = socket.gethostname()
+    hostname = hostname.replace('-', '_')
+
+    import optparse
+    parser = optparse.OptionParser(usage="usage: psi_monitor.py [--diag-hostname=cX]")
+    parser.add_option("--diag-hostname", dest="diag_hostname",
+                      help="Computer name in diagnostics output (ex: 'c1')",
+                      metavar="DIAG_HOSTNAME",
+                      action="store", default = hostname)
+    options, args = parser.parse_args(rospy.myargv())
+
+    try:
+        rospy.init_node('psi_monitor_%s' % hostname)
+    except rospy.exceptions.ROSInitException:
+        print('PSI monitor is unable to initialize node. Master may not be running.')
+        sys.exit(0)
+
+    psi_node = PSIMonitor(hostname, options.diag_hostname)
+
+    rate = rospy.Rate(1.0)
+    try:
+        while not rospy.is_shutdown():
+            rate.sleep()
+            psi_node.publish_stats()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        traceback.print_exc()
+        rospy.logerr(traceback.format_exc())
+
+    psi_node.cancel_timers()
+    sys.exit(0)
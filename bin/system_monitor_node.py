@@ -5,6 +5,12 @@ import re
 from diagnostic_msgs.msg import DiagnosticArray
 from system_monitor.msg import *
 
+number_re = re.compile(r'[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?')
+
+#Parse number from value with unit, like '12.5%' or '2100MHz'
+def parse_number(value):
+    return float(number_re.match(value).group(0))
+
 class Monitor():
 
     def __init__(self):
@@ -25,20 +31,25 @@ class Monitor():
         net_status = NetStatus()
         net_status.status = status.values[0].value
         net_status.time = float(status.values[1].value)
-        ifaces = (len(status.values) - 2) / 10
-        ifaces = int(ifaces)
-        for i in range(0, ifaces):
+        #Group values by interface, each interface starts with its name
+        ifaces = []
+        for value in status.values[2:]:
+            if value.key == 'Interface Name':
+                ifaces.append({})
+            if ifaces:
+                ifaces[-1][value.key] = value.value
+        for iface in ifaces:
             inter = Interface()
-            inter.name = status.values[2+10*i].value
-            inter.state = status.values[3+10*i].value
-            inter.input = float(status.values[4+10*i].value[:-8])
-            inter.output = float(status.values[5+10*i].value[:-8])
-            inter.mtu = int(status.values[6+10*i].value)
-            inter.input_percentage = float(status.values[7+10*i].value[:-1])
-            inter.output_percentage = float(status.values[8+10*i].value[:-1])
-            inter.collisions = int(status.values[9+10*i].value)
-            inter.rxError = int(status.values[10+10*i].value)
-            inter.txError = int(status.values[11+10*i].value)
+            inter.name = iface['Interface Name']
+            inter.state = iface.get('State', 'unknown')
+            inter.input = parse_number(iface['Input Traffic'])
+            inter.output = parse_number(iface['Output Traffic'])
+            inter.mtu = int(iface.get('MTU', 0))
+            inter.input_percentage = parse_number(iface['Input Percentage'])
+            inter.output_percentage = parse_number(iface['Output percentage'])
+            inter.collisions = int(iface['Collisions'])
+            inter.rxError = int(iface['Rx Errors'])
+            inter.txError = int(iface['Tx Errors'])
             net_status.interfaces.append(inter)
         self._diag_net.status = net_status
         #self.publish_info()
@@ -48,23 +59,24 @@ class Monitor():
         self._diag_mem.name = status.name
         self._diag_mem.message = status.message
         self._diag_mem.hardware_id = status.hardware_id
+        mem_dict = dict(zip([x.key for x in status.values], [x.value for x in status.values]))
         mem_status = MEMStatus()
-        mem_status.time = float(status.values[1].value)
-        mem_status.totalM = int(status.values[-3].value[:-1])
-        mem_status.usedM = int(status.values[-2].value[:-1])
-        mem_status.freeM = int(status.values[-1].value[:-1])
+        mem_status.time = float(mem_dict['Time Since Update'])
+        mem_status.totalM = int(parse_number(mem_dict['Total Memory']))
+        mem_status.usedM = int(parse_number(mem_dict['Used Memory']))
+        mem_status.freeM = int(parse_number(mem_dict['Free Memory']))
         names = ['Physical','Swap']
         for i in range(0, 2):
             mem = Memory()
             mem.name = names[i]
-            mem.total = int(status.values[3+5*i].value[:-1])
-            mem.used = int(status.values[4+5*i].value[:-1])
-            mem.free = int(status.values[5+5*i].value[:-1])
+            mem.total = int(parse_number(mem_dict['Total Memory (%s)' % names[i]]))
+            mem.used = int(parse_number(mem_dict['Used Memory (%s)' % names[i]]))
+            mem.free = int(parse_number(mem_dict['Free Memory (%s)' % names[i]]))
             mem_status.memories.append(mem)
         mem = Memory()
         mem.name = "Physical w/o buffers"
-        mem.used = int(status.values[6].value[:-1])
-        mem.free = int(status.values[7].value[:-1])
+        mem.used = int(parse_number(mem_dict['Used Memory (Physical w/o Buffers)']))
+        mem.free = int(parse_number(mem_dict['Free Memory (Physical w/o Buffers)']))
         mem_status.memories.append(mem)
         self._diag_mem.status = mem_status
         #self.publish_info()
@@ -95,22 +107,23 @@ class Monitor():
         self._diag_cpu_usa.hardware_id = status.hardware_id
         usage_dict = dict(zip([x.key for x in status.values], [x.value for x in status.values]))
         aux_usa = CPUUsageStatus()
-        num_cores = len([x for x in usage_dict.keys() if (x.startswith('Core') and x.endswith('Status'))])
+        core_ids = [x.split()[1] for x in usage_dict.keys() if (x.startswith('Core') and x.endswith('Status'))]
+        core_ids.sort(key=int)
         aux_usa.status = usage_dict['Update Status']
         aux_usa.time = float(usage_dict['Time Since Update'])
         aux_usa.load_status = usage_dict['Load Average Status']
-        aux_usa.load_avg1 = float(re.sub('[^0-9.]', '', usage_dict['Load Average (1min)']))
-        aux_usa.load_avg5 = float(re.sub('[^0-9.]', '', usage_dict['Load Average (5min)']))
-        aux_usa.load_avg15 = float(re.sub('[^0-9.]', '', usage_dict['Load Average (15min)']))
-        for i in range(0, num_cores):
+        aux_usa.load_avg1 = parse_number(usage_dict['Load Average (1min)'])
+        aux_usa.load_avg5 = parse_number(usage_dict['Load Average (5min)'])
+        aux_usa.load_avg15 = parse_number(usage_dict['Load Average (15min)'])
+        for i in core_ids:
             core = CoreUsage()
-            core.id = i
-            core.speed = float(re.sub('[^0-9.]', '', usage_dict['Core %d Clock Speed' % i]))
-            core.status = usage_dict['Core %d Status' % i]
-            core.system = float(re.sub('[^0-9.]', '', usage_dict['Core %d System' % i]))
-            core.user = float(re.sub('[^0-9.]', '', usage_dict['Core %d User' % i]))
-            core.nice = float(re.sub('[^0-9.]', '', usage_dict['Core %d Nice' % i]))
-            core.idle = float(re.sub('[^0-9.]', '', usage_dict['Core %d Idle' % i]))
+            core.id = int(i)
+            core.speed = parse_number(usage_dict.get('Core %s Clock Speed' % i, '0'))
+            core.status = usage_dict['Core %s Status' % i]
+            core.system = parse_number(usage_dict['Core %s System' % i])
+            core.user = parse_number(usage_dict['Core %s User' % i])
+            core.nice = parse_number(usage_dict['Core %s Nice' % i])
+            core.idle = parse_number(usage_dict['Core %s Idle' % i])
             aux_usa.cores.append(core)
         self._diag_cpu_usa.status = aux_usa
         #self.publish_info()
@@ -120,21 +133,27 @@ class Monitor():
         self._diag_hdd.name = status.name
         self._diag_hdd.message = status.message
         self._diag_hdd.hardware_id = status.hardware_id
+        hdd_dict = dict(zip([x.key for x in status.values], [x.value for x in status.values]))
         aux_stat = HDDStatus()
-        aux_stat.status = status.values[0].value
-        aux_stat.time = float(status.values[1].value)
-        aux_stat.space_reading = status.values[2].value
-        num_disks = (len(status.values) - 3)/6
-        num_disks = int(num_disks)
-        for i in range(0,num_disks):
+        aux_stat.status = hdd_dict['Update Status']
+        aux_stat.time = float(hdd_dict['Time Since Update'])
+        aux_stat.space_reading = hdd_dict['Disk Space Reading']
+        disk_ids = [int(x.split()[1]) for x in hdd_dict.keys() if (x.startswith('Disk') and x.endswith(' Name'))]
+        disk_ids.sort()
+        for i in disk_ids:
             disk = Disk()
-            disk.id = i + 1
-            disk.name = status.values[3 + i * 6].value
-            disk.size = float(status.values[4 + i * 6].value[:-1])
-            disk.available = float(status.values[5 + i * 6].value[:-1])
-            disk.use = float(status.values[6 + i * 6].value[:-1])
-            disk.status = status.values[7 + i * 6].value
-            disk.mount_point = status.values[8 + i * 6].value
+            disk.id = i
+            disk.name = hdd_dict['Disk %d Name' % i]
+            #Stalled mounts have no usage values
+            disk.size = parse_number(hdd_dict.get('Disk %d Size' % i, '0'))
+            disk.available = parse_number(hdd_dict.get('Disk %d Available' % i, '0'))
+            disk.use = parse_number(hdd_dict.get('Disk %d Use' % i, '0'))
+            disk.reserved = parse_number(hdd_dict.get('Disk %d Reserved' % i, '0'))
+            disk.inodes_used = int(hdd_dict.get('Disk %d Inodes Used' % i, 0))
+            disk.inodes_free = int(hdd_dict.get('Disk %d Inodes Free' % i, 0))
+            disk.inode_use = parse_number(hdd_dict.get('Disk %d Inode Use' % i, '0'))
+            disk.status = hdd_dict['Disk %d Status' % i]
+            disk.mount_point = hdd_dict['Disk %d Mount Point' % i]
             aux_stat.disks.append(disk)
         self._diag_hdd.status = aux_stat
         #self.publish_info()
@@ -0,0 +1,287 @@
+############################################################################
+#    Copyright (C) 2009, Willow Garage, Inc.                               #
+#    Copyright (C) 2013 by Ralf Kaestner                                   #
+#    ralf.kaestner@gmail.com                                               #
+#    Copyright (C) 2013 by Jerome Maye                                     #
+#    jerome.maye@mavt.ethz.ch                                              #
+#                                                                          #
+#    All rights reserved.                                                  #
+#                                                                          #
+#    Redistribution and use in source and binary forms, with or without    #
+#    modification, are permitted provided that the following conditions    #
+#    are met:                                                              #
+#                                                                          #
+#    1. Redistributions of source code must retain the above copyright     #
+#       notice, this list of conditions and the following disclaimer.      #
+#                                                                          #
+#    2. Redistributions in binary form must reproduce the above copyright  #
+#       notice, this list of conditions and the following disclaimer in    #
+#       the documentation and/or other materials provided with the         #
+#       distribution.                                                      #
+#                                                                          #
+#    3. The name of the copyright holders may be used to endorse or        #
+#       promote products derived from this software without specific       #
+#       prior written permission.                                          #
+#                                                                          #
+#    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS   #
+#    "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT     #
+#    LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS     #
+#    FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE        #
+#    COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,  #
+#    INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,  #
+#    BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;      #
+#    LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER      #
+#    CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT    #
+#    LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN     #
+#    ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE       #
+#    POSSIBILITY OF SUCH DAMAGE.                                           #
+############################################################################
+
+##\brief Helpers shared by the system monitor nodes
+
+import os
+import time
+import errno
+import array
+import collections
+
+if hasattr(time, 'monotonic'):
+    monotonic_time = time.monotonic
+else:
+    monotonic_time = time.time
+
+##\brief File which is opened once and re-read from the start on demand
+##
+## Avoids forking 'cat' or re-opening small /proc and /sys files on every
+## cycle. The descriptor is reopened only if the kernel object behind it
+## went away (ENODEV/ESTALE), e.g. after a hotplug event.
+class CachedFile():
+    def __init__(self, path, size = 4096):
+        self.path = path
+        self._fd = None
+        self._buf = bytearray(size)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        count = 0
+        while True:
+            if count == len(self._buf):
+                self._buf.extend(bytearray(len(self._buf)))
+            view = memoryview(self._buf)[count:]
+            if hasattr(os, 'readv'):
+                n = os.readv(self._fd, [ view ])
+            else:
+                data = os.read(self._fd, len(view))
+                n = len(data)
+                view[:n] = data
+            del view
+            if n == 0:
+                break
+            count += n
+
+        return bytes(self._buf[:count]).decode('UTF-8', 'replace')
+
+    ## Returns file contents as string
+    def read(self):
+        try:
+            return self._read()
+        except (OSError, IOError) as e:
+            if e.errno not in (errno.ENODEV, errno.ESTALE):
+                raise
+            self.close()
+            return self._read()
+
+##\brief Forecasts when a decreasing resource runs out
+##
+## Fits a least squares line to the last num_samples samples. The sums of
+## the fit are updated on every sample and rebuilt from the ring buffer
+## once per window to avoid drift, so an update is O(1) amortized.
+class ExhaustionForecaster():
+    def __init__(self, num_samples = 60):
+        self._num_samples = max(3, int(num_samples))
+        self._times = array.array('d', [ 0.0 ] * self._num_samples)
+        self._values = array.array('d', [ 0.0 ] * self._num_samples)
+        self._index = 0
+        self._count = 0
+        self._origin = None
+        self._last_time = 0.0
+        self._sums = [ 0.0, 0.0, 0.0, 0.0 ]
+
+    ## Moves the time origin to the oldest sample and rebuilds the sums
+    def _rebase(self):
+        oldest = min(self._times)
+        for i in range(self._num_samples):
+            self._times[i] -= oldest
+        self._origin += oldest
+        self._last_time -= oldest
+        self._sums = [ sum(self._times), sum(self._values),
+                       sum([ t*t for t in self._times ]),
+                       sum([ t*v for t, v in zip(self._times, self._values) ]) ]
+
+    def add(self, t, value):
+        if self._origin is None:
+            self._origin = t
+        t -= self._origin
+
+        if self._count == self._num_samples:
+            old_t = self._times[self._index]
+            old_value = self._values[self._index]
+            self._sums[0] -= old_t
+            self._sums[1] -= old_value
+            self._sums[2] -= old_t*old_t
+            self._sums[3] -= old_t*old_value
+        else:
+            self._count += 1
+
+        self._times[self._index] = t
+        self._values[self._index] = value
+        self._sums[0] += t
+        self._sums[1] += value
+        self._sums[2] += t*t
+        self._sums[3] += t*value
+        self._last_time = t
+
+        self._index = (self._index + 1) % self._num_samples
+        if self._index == 0:
+            self._rebase()
+
+    ## Returns seconds until the fitted value reaches zero, None if it is
+    ## not decreasing or there are too few samples
+    def time_to_exhaustion(self):
+        if self._count < 3:
+            return None
+        n = float(self._count)
+        sum_t, sum_value, sum_tt, sum_tvalue = self._sums
+        denom = n*sum_tt - sum_t*sum_t
+        if denom <= 0:
+            return None
+        slope = (n*sum_tvalue - sum_t*sum_value)/denom
+        if slope >= 0:
+            return None
+        value = sum_value/n + slope*(self._last_time - sum_t/n)
+        return max(value, 0.0)/-slope
+
+## Returns stripped contents of a sysfs attribute, empty if it cannot be read
+def read_sysfs_attr(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return ''
+
+Sensor = collections.namedtuple('Sensor', [ 'driver', 'label', 'type', 'source', 'path' ])
+
+##\brief Index of the hwmon and thermal zone temperature sensors
+##
+## Enumerates /sys/class/hwmon and /sys/class/thermal instead of walking
+## /sys/devices. The index is rebuilt only if a device appears or goes away.
+## Sensors are typed as 'cpu', 'drive' or 'other' by their driver.
+class SensorIndex():
+    cpu_drivers = [ 'coretemp', 'k10temp', 'k8temp', 'zenpower', 'cpu_thermal',
+                    'cpu-thermal', 'via_cputemp', 'fam15h_power' ]
+    drive_drivers = [ 'drivetemp', 'nvme' ]
+
+    def __init__(self, hwmon_root = '/sys/class/hwmon', thermal_root = '/sys/class/thermal'):
+        self._hwmon_root = hwmon_root
+        self._thermal_root = thermal_root
+        self._devices = None
+        self._sensors = []
+
+    def _list_dir(self, path, prefix):
+        try:
+            return sorted([ x for x in os.listdir(path) if x.startswith(prefix) ])
+        except OSError:
+            return []
+
+    def _sensor_type(self, driver):
+        if driver in self.cpu_drivers or driver == 'x86_pkg_temp':
+            return 'cpu'
+        if driver in self.drive_drivers:
+            return 'drive'
+        if 'cpu' in driver:
+            return 'cpu'
+        return 'other'
+
+    def _index_hwmon(self, hwmon):
+        sensors = []
+        dev_path = os.path.join(self._hwmon_root, hwmon)
+        driver = read_sysfs_attr(os.path.join(dev_path, 'name'))
+
+        inputs = [ x for x in os.listdir(dev_path) if x.startswith('temp') and x.endswith('_input') ]
+        inputs.sort(key = lambda x: int(x[4:-6]) if x[4:-6].isdigit() else 0)
+        for name in inputs:
+            path = os.path.join(dev_path, name)
+            label = read_sysfs_attr(path[:-len('_input')] + '_label')
+            if not label:
+                label = '%s %s' % (driver or hwmon, name[:-len('_input')])
+            sensors.append(Sensor(driver, label, self._sensor_type(driver), 'hwmon', path))
+
+        return sensors
+
+    def _index_thermal(self, zone):
+        zone_path = os.path.join(self._thermal_root, zone)
+        zone_type = read_sysfs_attr(os.path.join(zone_path, 'type'))
+        return Sensor(zone_type, zone_type or zone, self._sensor_type(zone_type),
+                      'thermal', os.path.join(zone_path, 'temp'))
+
+    ## Rebuilds the index if the set of hwmon or thermal devices changed
+    def refresh(self):
+        hwmons = self._list_dir(self._hwmon_root, 'hwmon')
+        zones = self._list_dir(self._thermal_root, 'thermal_zone')
+        if (hwmons, zones) == self._devices:
+            return False
+
+        sensors = []
+        for hwmon in hwmons:
+            try:
+                sensors.extend(self._index_hwmon(hwmon))
+            except OSError:
+                continue # Device went away while indexing
+        for zone in zones:
+            sensors.append(self._index_thermal(zone))
+
+        # Labels repeat across sockets, e.g. 'Core 0' on every coretemp device
+        labels = collections.Counter([ (x.type, x.label) for x in sensors ])
+        self._sensors = [ x._replace(label = '%s (%s)' % (x.label, x.path.split('/')[-2]))
+                          if labels[(x.type, x.label)] > 1 else x for x in sensors ]
+        self._devices = (hwmons, zones)
+        return True
+
+    ## Returns indexed sensors, optionally filtered by type and source
+    def sensors(self, sensor_type = None, source = None):
+        return [ x for x in self._sensors
+                 if (sensor_type is None or x.type == sensor_type) and
+                    (source is None or x.source == source) ]
+
+##\brief Reads sensor files through descriptors kept open between calls
+class TempSensorReader():
+    def __init__(self):
+        self._files = {}
+
+    def close(self):
+        for temp_file in self._files.values():
+            temp_file.close()
+        self._files = {}
+
+    ## Returns list of (label, value) with the raw millidegree strings
+    def read(self, sensors):
+        paths = set([ x.path for x in sensors ])
+        for path in list(self._files.keys()):
+            if path not in paths:
+                self._files.pop(path).close()
+
+        temps = []
+        for sensor in sensors:
+            if sensor.path not in self._files:
+                self._files[sensor.path] = CachedFile(sensor.path, 32)
+            temps.append((sensor.label, self._files[sensor.path].read().strip()))
+
+        return temps
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+##\brief Tests of the SNTP client of ntp_monitor.py against a local UDP
+## server
+
+import os
+import sys
+import socket
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import ntp_monitor
+
+##\brief Answers one SNTP request on localhost with a clock offset by
+## offset seconds
+class FakeServer():
+    def __init__(self, offset = 0.0, stratum = 2, echo = True):
+        self._offset = offset
+        self._stratum = stratum
+        self._echo = echo
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.settimeout(2.0)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target = self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        try:
+            data, addr = self._sock.recvfrom(1024)
+        except socket.timeout:
+            return
+        request = ntp_monitor.ntp_packet.unpack_from(data)
+        origin = list(request[13:15]) if self._echo else [ 0, 1 ]
+        t2 = ntp_monitor.time_to_ntp(time.time() + self._offset)
+        t3 = ntp_monitor.time_to_ntp(time.time() + self._offset)
+        # Server mode 4, version 4, no leap warning
+        reply = ntp_monitor.ntp_packet.pack(0x24, self._stratum, 0, -20,
+                                            *([ 0 ]*5 + origin + list(t2) + list(t3)))
+        self._sock.sendto(reply, addr)
+
+    def close(self):
+        self._thread.join()
+        self._sock.close()
+
+class TestNtpConversion(unittest.TestCase):
+    def test_round_trip(self):
+        t = 1600000000.25
+        self.assertAlmostEqual(ntp_monitor.ntp_to_time(*ntp_monitor.time_to_ntp(t)), t, places = 6)
+
+    def test_epoch(self):
+        self.assertEqual(ntp_monitor.time_to_ntp(0.0), (ntp_monitor.NTP_EPOCH_OFFSET, 0))
+
+class TestSntpQuery(unittest.TestCase):
+    def query(self, server):
+        try:
+            return ntp_monitor.sntp_query([ '127.0.0.1' ], 1.0, server.port)
+        finally:
+            server.close()
+
+    def test_offset(self):
+        host, offset, delay, error = self.query(FakeServer(offset = 0.5))[0]
+        self.assertIsNone(error)
+        self.assertAlmostEqual(offset, 0.5, places = 2)
+        self.assertTrue(0.0 <= delay < 0.5)
+
+    def test_unsynchronized(self):
+        host, offset, delay, error = self.query(FakeServer(stratum = 0))[0]
+        self.assertIsNone(offset)
+        self.assertIn('stratum', error)
+
+    def test_mismatched_reply(self):
+        host, offset, delay, error = self.query(FakeServer(echo = False))[0]
+        self.assertIsNone(offset)
+        self.assertEqual(error, 'Reply does not match request')
+
+    def test_unresolvable(self):
+        results = ntp_monitor.sntp_query([ 'invalid.invalid', 'invalid.invalid' ], 1.0)
+        self.assertEqual([ x[0] for x in results ], [ 'invalid.invalid' ]*2)
+        self.assertTrue(all([ x[3] is not None for x in results ]))
+
+if __name__ == '__main__':
+    unittest.main()